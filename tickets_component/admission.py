@@ -0,0 +1,97 @@
+import math
+import secrets
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.http import JsonResponse
+
+TOKEN_HEADER = 'X-Admission-Token'
+
+
+# Per-event virtual FIFO admitting `rate` requests per second with bursts of up to `burst` requests.
+# Every request takes the next free slot (slots are 1 / rate apart). A request whose slot is due is admitted
+# at once, the other ones get a token for their slot and are admitted when they come back with it on time.
+# Requests which would wait longer than `max_wait` are rejected without taking a slot.
+class AdmissionQueue:
+    def __init__(self, rate, burst, max_wait):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.max_wait = max_wait
+        self._next_slot = {}
+        self._tokens = {}
+        self._cleanup_at = 1000
+        self._lock = threading.Lock()
+
+    def _remove_stale_tokens(self, now):
+        # tokens of clients who never came back expire a while after their slot
+        for token, (_, slot) in list(self._tokens.items()):
+            if slot + self.max_wait < now:
+                del self._tokens[token]
+        self._cleanup_at = 2 * len(self._tokens) + 1000
+
+    def admit(self, event_id, token=None, now=None):
+        # returns (admitted, token, seconds to wait); a rejected request without a token has to retry later
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if token in self._tokens and self._tokens[token][0] == event_id:
+                slot = self._tokens[token][1]
+                if slot <= now:
+                    del self._tokens[token]
+                    return True, None, 0
+                return False, token, slot - now
+
+            next_slot = max(self._next_slot.get(event_id, now), now)
+            slot = next_slot - self.tolerance
+            if slot - now > self.max_wait:
+                return False, None, slot - now
+            self._next_slot[event_id] = next_slot + self.interval
+            if slot <= now:
+                return True, None, 0
+            if len(self._tokens) >= self._cleanup_at:
+                self._remove_stale_tokens(now)
+            token = secrets.token_urlsafe(16)
+            self._tokens[token] = (event_id, slot)
+            return False, token, slot - now
+
+    def wait(self, event_id, token, now=None):
+        # seconds until the slot of the token, None for unknown tokens
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if token not in self._tokens or self._tokens[token][0] != event_id:
+                return None
+            return max(self._tokens[token][1] - now, 0)
+
+    def position(self, wait):
+        return math.ceil(wait / self.interval)
+
+
+queue = AdmissionQueue(
+    rate=settings.ADMISSION_RATE, burst=settings.ADMISSION_BURST, max_wait=settings.ADMISSION_MAX_WAIT
+)
+
+
+def _waiting_response(token, wait):
+    if token is None:
+        response = JsonResponse({'message': 'Too many requests, try again later.'}, status=503)
+    else:
+        response = JsonResponse({
+            'message': 'Too many requests, wait for your turn.',
+            'token': token,
+            'position': queue.position(wait),
+            'retry_after': wait,
+        }, status=429)
+    response['Retry-After'] = str(math.ceil(wait))
+    return response
+
+
+def admission_control(view):
+    # wraps the whole DRF view, so the excess traffic is turned away before authentication and the ORM
+    @wraps(view)
+    def wrapper(request, event_id, *args, **kwargs):
+        admitted, token, wait = queue.admit(event_id, request.headers.get(TOKEN_HEADER))
+        if not admitted:
+            return _waiting_response(token, wait)
+        return view(request, event_id, *args, **kwargs)
+    return wrapper
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class TicketsComponentConfig(AppConfig):
     name = 'tickets_component'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,326 @@
+import datetime
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from tickets_system import celery_app
+
+from .models import Event, AvailableTicket, TicketReservation, PurchasedTicket, Checkout, TICKET_TYPES
+from . import admission, caching, rollups
+
+SCENARIOS = {}
+SEED_BATCH_SIZE = 10000
+
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+@contextmanager
+def benchmark_environment():
+    # the waiting room would throttle the load itself and the capture has no worker to run on
+    unthrottled = admission.AdmissionQueue(rate=10 ** 9, burst=10 ** 9, max_wait=0)
+    always_eager = celery_app.conf.task_always_eager
+    celery_app.conf.task_always_eager = True
+    try:
+        with mock.patch.object(admission, 'queue', unthrottled):
+            yield
+    finally:
+        celery_app.conf.task_always_eager = always_eager
+
+
+def _batches(objects, size=SEED_BATCH_SIZE):
+    objects = iter(objects)
+    while True:
+        batch = list(islice(objects, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Dataset:
+    def __init__(self, events, reservations, purchases):
+        now = datetime.datetime.now()
+        User = get_user_model()
+        # ten reservations per user, like a busy on-sale
+        users = max(reservations // 10, 1)
+        for batch in _batches(User(username=f'benchmark {i}') for i in range(users)):
+            User.objects.bulk_create(batch)
+        for batch in _batches(Event(name=f'event {i}', datetime=now + datetime.timedelta(minutes=i))
+                              for i in range(events)):
+            Event.objects.bulk_create(batch)
+        self.event_ids = list(Event.objects.values_list('id', flat=True))
+        for batch in _batches(AvailableTicket(event_id=event_id, amount_of_tickets=10 ** 6, price=5.0, type=type_)
+                              for event_id in self.event_ids for type_, _ in TICKET_TYPES):
+            AvailableTicket.objects.bulk_create(batch)
+        self.tickets = {}
+        for ticket_id, event_id in AvailableTicket.objects.values_list('id', 'event_id'):
+            self.tickets.setdefault(event_id, []).append(ticket_id)
+        ticket_ids = [ticket_id for ids in self.tickets.values() for ticket_id in ids]
+        self.user_ids = list(User.objects.filter(username__startswith='benchmark').values_list('id', flat=True))
+
+        for batch in _batches(
+            TicketReservation(owner_id=self.user_ids[i % len(self.user_ids)], ticket_id=ticket_ids[i % len(ticket_ids)],
+                              amount_of_tickets=1, amount_to_pay=5.0,
+                              expiration_datetime=now + datetime.timedelta(seconds=i % 900))
+            for i in range(reservations)
+        ):
+            TicketReservation.objects.bulk_create(batch)
+        for batch in _batches(
+            PurchasedTicket(owner_id=self.user_ids[i % len(self.user_ids)], ticket_id=ticket_ids[i % len(ticket_ids)],
+                            amount_of_tickets=1)
+            for i in range(purchases)
+        ):
+            PurchasedTicket.objects.bulk_create(batch)
+        rollups.rebuild_purchased_statistics()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+
+def summary(name, durations, query_counts=None, errors=0, elapsed=None):
+    durations = sorted(durations)
+    result = {
+        'name': name,
+        'requests': len(durations),
+        'errors': errors,
+        'rps': len(durations) / (elapsed if elapsed is not None else sum(durations)),
+        'mean_ms': statistics.mean(durations) * 1000,
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p95_ms': percentile(durations, 95) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+    }
+    if query_counts is not None:
+        result['queries_per_request'] = statistics.mean(query_counts)
+    return result
+
+
+def run_concurrently(name, send, users, requests, concurrency):
+    # every worker is a separate client (and database connection) sending its share of the requests
+    def worker(worker_id):
+        client = APIClient()
+        # a session rather than force_authenticate, which plain Django views like the async payment ignore
+        client.force_login(users[worker_id % len(users)])
+        rnd = random.Random(worker_id)
+        durations, query_counts, errors = [], [], 0
+        try:
+            for i in range(worker_id, requests, concurrency):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    try:
+                        errors += send(client, rnd, worker_id, i).status_code >= 400
+                    except Exception:
+                        errors += 1
+                    durations.append(time.perf_counter() - started)
+                query_counts.append(len(queries))
+        finally:
+            connection.close()
+        return durations, query_counts, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return summary(
+        name,
+        [d for durations, _, _ in results for d in durations],
+        [q for _, query_counts, _ in results for q in query_counts],
+        sum(errors for _, _, errors in results),
+        elapsed,
+    )
+
+
+@scenario
+def endpoints(options):
+    dataset = Dataset(options['events'], options['reservations'], options['purchases'])
+    users = list(get_user_model().objects.filter(id__in=dataset.user_ids[:options['concurrency']]))
+    requests, concurrency = options['requests'], options['concurrency']
+
+    def event_id(rnd):
+        return rnd.choice(dataset.event_ids)
+
+    def reserve(client, rnd, worker_id, i):
+        e = event_id(rnd)
+        return client.post(f'/api/event/{e}/reserve_ticket', {'ticket': dataset.tickets[e][0], 'amount_of_tickets': 1})
+
+    def reserve_basket(client, rnd, worker_id, i):
+        e = event_id(rnd)
+        return client.post(f'/api/event/{e}/reserve_tickets', {'tickets': [
+            {'ticket': ticket_id, 'amount_of_tickets': 1} for ticket_id in dataset.tickets[e]
+        ]}, format='json')
+
+    def payable_reservations():
+        # one fresh reservation per payment request, owned by the user of the worker sending it
+        expiration_datetime = datetime.datetime.now() + datetime.timedelta(hours=1)
+        ticket_id = dataset.tickets[dataset.event_ids[0]][0]
+        TicketReservation.objects.bulk_create([
+            TicketReservation(owner=users[i % concurrency % len(users)], ticket_id=ticket_id, amount_of_tickets=1,
+                              amount_to_pay=5.0, expiration_datetime=expiration_datetime)
+            for i in range(requests)
+        ])
+        ids = TicketReservation.objects.filter(expiration_datetime=expiration_datetime).order_by('id')
+        return list(ids.values_list('id', flat=True))
+
+    def pay(path, format_=None):
+        reservation_ids = payable_reservations()
+
+        def send(client, rnd, worker_id, i):
+            return client.post(path, {'reservations': [reservation_ids[i]], 'currency': 'EUR', 'amount': 5.0},
+                               format=format_)
+        return send
+
+    def extend():
+        reservation_ids = payable_reservations()
+        return lambda client, rnd, worker_id, i: client.post(f'/api/reservations/{reservation_ids[i]}/extend')
+
+    def checkout_status(status, query=''):
+        # one checkout per user, read by the worker of the user
+        checkouts = {user.id: Checkout.objects.create(owner=user, amount=5.0, currency='EUR', status=status).id
+                     for user in users}
+
+        def send(client, rnd, worker_id, i):
+            return client.get(f'/api/reservations/payment/{checkouts[users[worker_id % len(users)].id]}{query}')
+        return send
+
+    def as_admin(path):
+        # the metrics are only exposed to the staff
+        get_user_model().objects.filter(id__in=[user.id for user in users]).update(is_staff=True)
+        return get(path)
+
+    def get(path):
+        return lambda client, rnd, worker_id, i: client.get(path.format(event_id=event_id(rnd)))
+
+    type_ = TICKET_TYPES[0][0]
+
+    plan = [
+        ('GET events/', lambda: get('/api/events/')),
+        ('GET event/<id>/', lambda: get('/api/event/{event_id}/')),
+        ('GET event/<id>/available_tickets', lambda: get('/api/event/{event_id}/available_tickets')),
+        ('POST event/<id>/reserve_ticket', lambda: reserve),
+        ('POST event/<id>/reserve_tickets', lambda: reserve_basket),
+        ('GET reservations/', lambda: get('/api/reservations/')),
+        ('POST reservations/<id>/extend', extend),
+        ('POST reservations/payment', lambda: pay('/api/reservations/payment')),
+        ('POST reservations/payment/async', lambda: pay('/api/reservations/payment/async', 'json')),
+        ('GET reservations/payment/<id>', lambda: checkout_status('succeeded')),
+        # a long-poll of a checkout which is never captured, held for the whole wait
+        ('GET reservations/payment/<id>?wait=0.2', lambda: checkout_status('pending', '?wait=0.2')),
+        ('GET statistics/available_tickets/', lambda: get('/api/statistics/available_tickets/')),
+        ('GET statistics/available_tickets/<type_>/', lambda: get(f'/api/statistics/available_tickets/{type_}/')),
+        ('GET statistics/reserved_tickets/', lambda: get('/api/statistics/reserved_tickets/')),
+        ('GET statistics/reserved_tickets/series/', lambda: get('/api/statistics/reserved_tickets/series/')),
+        ('GET statistics/reserved_tickets/<type_>/', lambda: get(f'/api/statistics/reserved_tickets/{type_}/')),
+        ('GET statistics/purchased_tickets/', lambda: get('/api/statistics/purchased_tickets/')),
+        ('GET statistics/purchased_tickets/<type_>/', lambda: get(f'/api/statistics/purchased_tickets/{type_}/')),
+        ('GET metrics/', lambda: as_admin('/api/metrics/')),
+    ]
+    results = [run_concurrently(name, make_send(), users, requests, concurrency) for name, make_send in plan]
+
+    # the waiting room of the benchmark admits every request, so the tokens come from one which admits none
+    waiting = admission.AdmissionQueue(rate=1, burst=1, max_wait=10 ** 9)
+    e = dataset.event_ids[0]
+    tokens = [waiting.admit(e)[1] for _ in range(requests + 1)][1:]
+    with mock.patch.object(admission, 'queue', waiting):
+        results.append(run_concurrently(
+            'GET event/<id>/admission/<token>',
+            lambda client, rnd, worker_id, i: client.get(f'/api/event/{e}/admission/{tokens[i]}'),
+            users, requests, concurrency
+        ))
+    return results
+
+
+@scenario
+def idempotency(options):
+    requests = options['requests']
+    user = get_user_model().objects.create_user(username='benchmark idempotency', password='some_password')
+    event = Event.objects.create(name='benchmark', datetime=datetime.datetime.now())
+    ticket = AvailableTicket.objects.create(event=event, amount_of_tickets=3 * requests, price=5.0, type='r')
+    client = APIClient()
+    client.force_authenticate(user)
+    url = f'/api/event/{event.id}/reserve_ticket'
+    data = {'ticket': ticket.id, 'amount_of_tickets': 1}
+
+    def measure(send):
+        durations = []
+        for i in range(requests):
+            started = time.perf_counter()
+            send(i)
+            durations.append(time.perf_counter() - started)
+        return durations
+
+    without_key = measure(lambda i: client.post(url, data))
+    new_keys = measure(lambda i: client.post(url, data, HTTP_IDEMPOTENCY_KEY=f'key {i}'))
+    replays = measure(lambda i: client.post(url, data, HTTP_IDEMPOTENCY_KEY='key 0'))
+    results = [
+        summary('reserve without Idempotency-Key', without_key),
+        summary('reserve with a new Idempotency-Key', new_keys),
+        summary('reserve replayed by Idempotency-Key', replays),
+    ]
+    for result in results[1:]:
+        result['overhead_ms'] = result['mean_ms'] - results[0]['mean_ms']
+    return results
+
+
+@scenario
+def reserve_path(options):
+    # queries of a reservation with the ticket terms cached and with the cache emptied before every request,
+    # which reads the ticket row like every reservation did before the cache
+    requests = options['requests']
+    user = get_user_model().objects.create_user(username='benchmark reserve path', password='some_password')
+    event = Event.objects.create(name='benchmark', datetime=datetime.datetime.now())
+    tickets = [AvailableTicket.objects.create(event=event, amount_of_tickets=10 * requests, price=5.0, type=type_)
+               for type_, _ in TICKET_TYPES]
+    client = APIClient()
+    client.force_authenticate(user)
+
+    def measure(path, data, cold, format_=None):
+        durations, query_counts = [], []
+        for i in range(requests):
+            if cold:
+                caching.invalidate(caching.TICKET_TERMS)
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                client.post(path, data, format=format_)
+                durations.append(time.perf_counter() - started)
+            query_counts.append(len(queries))
+        return durations, query_counts
+
+    ticket = f'/api/event/{event.id}/reserve_ticket', {'ticket': tickets[0].id, 'amount_of_tickets': 1}
+    basket = f'/api/event/{event.id}/reserve_tickets', {'tickets': [
+        {'ticket': t.id, 'amount_of_tickets': 1} for t in tickets
+    ]}
+    return [
+        summary('reserve_ticket with cold ticket terms', *measure(*ticket, cold=True)),
+        summary('reserve_ticket', *measure(*ticket, cold=False)),
+        summary('reserve_tickets with cold ticket terms', *measure(*basket, cold=True, format_='json')),
+        summary('reserve_tickets', *measure(*basket, cold=False, format_='json')),
+    ]
+
+
+def compare(results, baseline, tolerance):
+    # lists the regressions of latency and query counts against the baseline
+    regressions = []
+    for scenario_name, scenario_results in results.items():
+        for result in scenario_results:
+            base = baseline.get(scenario_name, {}).get(result['name'])
+            if base is None:
+                continue
+            for metric in ('p95_ms', 'queries_per_request'):
+                if metric in base and result.get(metric, 0) > base[metric] * (1 + tolerance):
+                    regressions.append(
+                        f'{scenario_name} / {result["name"]}: {metric} {result[metric]:.3f} > {base[metric]:.3f}'
+                    )
+    return regressions
@@ -0,0 +1,61 @@
+import contextlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import routers
+
+CATALOGUE = 'catalogue'
+STATISTICS = 'statistics'
+# price, event and hold of every ticket type, read by the reservations
+TICKET_TERMS = 'ticket_terms'
+
+
+def event_scope(event_id):
+    return f'event:{event_id}'
+
+
+def owner_scope(owner_id):
+    return f'owner:{owner_id}'
+
+
+def _version_key(scope):
+    return f'tickets:{scope}:version'
+
+
+def get_version(scope):
+    key = _version_key(scope)
+    version = cache.get(key)
+    if version is None:
+        # start from the clock, so a version evicted from the cache never revives entries stored under it
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _invalidated_key(scope):
+    return f'tickets:{scope}:invalidated'
+
+
+def invalidate(scope):
+    # marked before the new version is visible, so no entry of the new version is built from a lagging replica
+    if settings.REPLICA_DATABASES:
+        cache.set(_invalidated_key(scope), True, timeout=settings.READ_YOUR_WRITES_WINDOW)
+    try:
+        cache.incr(_version_key(scope))
+    except ValueError:
+        cache.set(_version_key(scope), time.time_ns(), timeout=None)
+
+
+def cached(scope, name, build, timeout=None):
+    key = f'tickets:{scope}:{get_version(scope)}:{name}'
+    value = cache.get(key)
+    if value is None:
+        # the replicas may not have the write which has just invalidated the scope, and the entry is shared by
+        # the users who read their writes
+        recent = settings.REPLICA_DATABASES and cache.get(_invalidated_key(scope)) is not None
+        with routers.primary_reads() if recent else contextlib.nullcontext():
+            value = build()
+        cache.set(key, value, timeout=timeout if timeout is not None else settings.TICKETS_CACHE_TIMEOUT)
+    return value
@@ -0,0 +1,155 @@
+import datetime
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import DateTimeField, Sum, Value
+from django.db.models.functions import Greatest
+
+from .models import TicketReservation, PurchasedTicket, Checkout
+from .payments_adapter import payments as payments_adapter
+from .signals import reservations_changed
+from . import rollups, metrics, expiry
+
+
+OPEN_STATUSES = ('pending', 'capturing')
+
+
+class CheckoutError(Exception):
+    pass
+
+
+def lock_reservations(owner, reservation_ids, amount_to_pay, now):
+    # one locking query validates the reservations; 'self' keeps the hot ticket rows unlocked for buyers
+    reservations = list(
+        TicketReservation.objects.select_for_update(of=('self',)).select_related('ticket').filter(
+            pk__in=reservation_ids, owner=owner, expiration_datetime__gte=now, checkout=None
+        )
+    )
+    if set(reservation_ids) != {r.id for r in reservations}:
+        raise CheckoutError('Reservation does not exist or expired.')
+    if amount_to_pay != sum(r.amount_to_pay for r in reservations):
+        raise CheckoutError('Wrong amount of money for this payment request.')
+    return reservations
+
+
+def complete_purchase(owner, reservations):
+    purchased_tickets = PurchasedTicket.objects.bulk_create([
+        PurchasedTicket(owner=owner, ticket=r.ticket, amount_of_tickets=r.amount_of_tickets) for r in reservations
+    ])
+    TicketReservation.objects.filter(pk__in=[r.id for r in reservations]).delete()
+    reservations_changed.send(sender=TicketReservation, owner_ids=[owner.id])
+    rollups.record_purchases(purchased_tickets)
+    return purchased_tickets
+
+
+def _hold(reservation_ids, until, **changes):
+    # keeps the reservations from expiring while the payment is charged outside of their transaction
+    expiry.register([until])
+    TicketReservation.objects.filter(pk__in=reservation_ids).update(
+        expiration_datetime=Greatest('expiration_datetime', Value(until, output_field=DateTimeField())), **changes
+    )
+
+
+def _claim(owner, reservation_ids, amount_to_pay, currency, token, hold_duration):
+    # links the reservations to a new pending checkout, so no other payment can claim them
+    now = datetime.datetime.now()
+    with transaction.atomic():
+        lock_reservations(owner, reservation_ids, amount_to_pay, now)
+        checkout = Checkout.objects.create(owner=owner, amount=amount_to_pay, currency=currency, token=token)
+        _hold(reservation_ids, now + hold_duration, checkout=checkout)
+        reservations_changed.send(sender=TicketReservation, owner_ids=[owner.id])
+    return checkout
+
+
+def hold_reservations(owner, reservation_ids, amount_to_pay, currency, token):
+    # claims the reservations for a payment charged right away by the request
+    return _claim(owner, reservation_ids, amount_to_pay, currency, token, settings.PAYMENT_HOLD_DURATION)
+
+
+def finish_checkout(checkout_id):
+    # converts the reservations of a charged checkout, which only its own payment can do
+    with transaction.atomic():
+        checkout = Checkout.objects.select_for_update().get(pk=checkout_id)
+        reservations = list(
+            TicketReservation.objects.select_for_update(of=('self',)).select_related('ticket').filter(
+                checkout=checkout
+            )
+        )
+        if checkout.status not in OPEN_STATUSES or not reservations or \
+                sum(r.amount_to_pay for r in reservations) != checkout.amount:
+            raise CheckoutError('Reservation does not exist or expired.')
+        complete_purchase(checkout.owner, reservations)
+        checkout.status = 'succeeded'
+        checkout.message = 'Payment succeeded.'
+        checkout.save()
+    return checkout
+
+
+def authorize(owner, reservation_ids, amount_to_pay, currency, token):
+    return _claim(owner, reservation_ids, amount_to_pay, currency, token, settings.CHECKOUT_HOLD_DURATION)
+
+
+def fail(checkout_id, message):
+    with transaction.atomic():
+        Checkout.objects.filter(pk=checkout_id, status__in=OPEN_STATUSES).update(status='failed', message=message)
+        # the reservations may be paid once again until they expire
+        TicketReservation.objects.filter(checkout=checkout_id).update(checkout=None)
+
+
+def reconcile(checkout_id):
+    # a charge which timed out may still be taken by the provider, so its checkout stays open with the reservations
+    # held until the background capture charges it once again with the same reference
+    with transaction.atomic():
+        reservation_ids = list(TicketReservation.objects.filter(
+            checkout=checkout_id, checkout__status__in=OPEN_STATUSES
+        ).values_list('pk', flat=True))
+        _hold(reservation_ids, datetime.datetime.now() + settings.CHECKOUT_HOLD_DURATION)
+
+
+def capture(checkout_id):
+    # charges the checkout and converts its reservations; payment errors worth retrying are raised
+    with transaction.atomic():
+        checkout = Checkout.objects.select_for_update().get(pk=checkout_id)
+        if checkout.status not in OPEN_STATUSES:
+            return checkout
+        amount = TicketReservation.objects.filter(checkout=checkout).aggregate(amount=Sum('amount_to_pay'))['amount']
+        if amount != checkout.amount:
+            fail(checkout_id, 'Reservation does not exist or expired.')
+            return checkout
+        checkout.status = 'capturing'
+        checkout.save(update_fields=['status'])
+
+    # no transaction (nor the SQLite write lock) is held while the gateway is charged; the checkout is the
+    # reference of the charge, so a capture retried after a crash isn't charged twice
+    try:
+        with metrics.timer('gateway'):
+            payment_result = payments_adapter.PaymentGateway().charge(
+                checkout.amount, checkout.token, checkout.currency, reference=f'checkout-{checkout.id}'
+            )
+    except (payments_adapter.CardError, payments_adapter.CurrencyError) as ex:
+        fail(checkout_id, str(ex))
+        return checkout
+    if payment_result.amount != checkout.amount or payment_result.currency != checkout.currency:
+        fail(checkout_id, 'Payment result does not match the payment request.')
+        return checkout
+    try:
+        return finish_checkout(checkout_id)
+    except CheckoutError as ex:
+        fail(checkout_id, str(ex))
+        return checkout
+
+
+@lru_cache(maxsize=None)
+def async_payment_gateway():
+    # one gateway per process, so its connections and concurrency limit are shared by all requests
+    if settings.PAYMENT_GATEWAY_FAKE_LATENCY is not None:
+        return payments_adapter.FakePaymentGateway(
+            latency=settings.PAYMENT_GATEWAY_FAKE_LATENCY,
+            timeout=settings.PAYMENT_GATEWAY_TIMEOUT,
+            max_concurrency=settings.PAYMENT_GATEWAY_MAX_CONCURRENCY,
+        )
+    return payments_adapter.AsyncPaymentGateway(
+        timeout=settings.PAYMENT_GATEWAY_TIMEOUT,
+        max_concurrency=settings.PAYMENT_GATEWAY_MAX_CONCURRENCY,
+    )
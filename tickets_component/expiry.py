@@ -0,0 +1,44 @@
+import datetime
+import threading
+
+from django.db import transaction
+
+from .models import ExpiryBucket
+
+BUCKET = datetime.timedelta(minutes=1)
+
+# minutes this process has already registered, so a busy minute costs one INSERT instead of one per reservation
+_registered = set()
+_lock = threading.Lock()
+
+
+def minute_of(dt):
+    return int(dt.timestamp() // 60)
+
+
+def start_of(minute):
+    return datetime.datetime.fromtimestamp(minute * 60)
+
+
+def register(expiration_datetimes):
+    # a bucket is only removed once its minute has gone by and holds always expire in the future, so a minute
+    # registered once stays registered
+    minutes = {minute_of(dt) for dt in expiration_datetimes}
+    with _lock:
+        minutes -= _registered
+    if not minutes:
+        return
+    ExpiryBucket.objects.bulk_create([ExpiryBucket(minute=minute) for minute in minutes], ignore_conflicts=True)
+
+    def remember():
+        with _lock:
+            current = minute_of(datetime.datetime.now())
+            _registered.difference_update([minute for minute in _registered if minute < current])
+            _registered.update(minute for minute in minutes if minute >= current)
+
+    # the buckets of a rolled back transaction are gone, so they are only remembered once it commits
+    transaction.on_commit(remember)
+
+
+def due_buckets(now):
+    return ExpiryBucket.objects.filter(minute__lte=minute_of(now)).order_by('minute').values_list('minute', flat=True)
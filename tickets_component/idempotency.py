@@ -0,0 +1,123 @@
+import datetime
+import json
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# finished responses only, so the database is asked just once per key and process
+_responses = LRUCache(settings.IDEMPOTENCY_LRU_SIZE)
+
+
+def _expired(stored, now):
+    if stored['status_code'] is None:
+        return stored['created'] < now - settings.IDEMPOTENCY_CLAIM_LEASE
+    return stored['created'] < now - settings.IDEMPOTENCY_KEY_TTL
+
+
+def _stored_response(owner_id, key, now):
+    stored = _responses.get((owner_id, key))
+    if stored is not None and _expired(stored, now):
+        # the key may have been claimed once again since
+        _responses.delete((owner_id, key))
+        stored = None
+    if stored is None:
+        stored = IdempotencyKey.objects.filter(owner_id=owner_id, key=key).values(
+            'path', 'status_code', 'response', 'created').first()
+        if stored is None or _expired(stored, now):
+            return None
+        if stored['status_code'] is not None:
+            _responses.set((owner_id, key), stored)
+    return stored
+
+
+def _replay(request, stored):
+    if stored is not None and stored['path'] != request.path:
+        return Response({'message': f'{HEADER} has already been used for another request.'}, status=422)
+    if stored is None or stored['status_code'] is None:
+        return Response({'message': f'A request with this {HEADER} is still in progress.'}, status=409)
+    return Response(stored['response'], status=stored['status_code'], headers={'Idempotent-Replayed': 'true'})
+
+
+def idempotent(view):
+    # must be applied below @api_view, so the request is already authenticated
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view(request, *args, **kwargs)
+        if len(key) > 255:
+            return Response({'message': f'{HEADER} is too long.'}, status=400)
+
+        now = datetime.datetime.now()
+        stored = _stored_response(request.user.id, key, now)
+        if stored is not None:
+            return _replay(request, stored)
+        try:
+            # the key is claimed before the view runs, so concurrent retries can't both execute it
+            with transaction.atomic():
+                IdempotencyKey.objects.filter(owner=request.user, key=key).filter(
+                    Q(created__lt=now - settings.IDEMPOTENCY_KEY_TTL) |
+                    Q(status_code=None, created__lt=now - settings.IDEMPOTENCY_CLAIM_LEASE)
+                ).delete()
+                claimed = IdempotencyKey.objects.create(owner=request.user, key=key, path=request.path)
+        except IntegrityError:
+            return _replay(request, _stored_response(request.user.id, key, now))
+
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            claimed.delete()
+            raise
+        if response.status_code >= 500:
+            claimed.delete()
+            return response
+        # a claim outliving its lease may have been taken over by a retry, which then stores its own response
+        IdempotencyKey.objects.filter(pk=claimed.pk, status_code=None).update(
+            status_code=response.status_code, response=json.loads(json.dumps(response.data, cls=JSONEncoder))
+        )
+        return response
+    return wrapper
+
+
+def remove_expired_keys(now):
+    return IdempotencyKey.objects.filter(created__lt=now - settings.IDEMPOTENCY_KEY_TTL).delete()[0]
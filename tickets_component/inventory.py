@@ -0,0 +1,238 @@
+import datetime
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .ledger import Ledger
+from .models import AvailableTicket, TicketReservation, ExpiryBucket, InventoryLedgerTake
+from .signals import stock_changed, reservations_changed
+from . import caching, expiry
+
+RECLAIM_BATCH_SIZE = 1000
+
+
+class ConcurrentReclaimError(Exception):
+    pass
+
+
+class InsufficientTicketsError(Exception):
+    pass
+
+
+# takes of the ledger made by the current `reserving` block, with their amounts
+_taken = ContextVar('tickets_taken_from_ledger', default=None)
+
+
+@lru_cache(maxsize=None)
+def ledger():
+    # one ledger per process, recovered from its journal and flushed in the background; only the reservations
+    # start it, since recovering the journal of another process would apply its entries twice
+    ledger = Ledger(settings.INVENTORY_LEDGER_JOURNAL, fsync=settings.INVENTORY_LEDGER_FSYNC)
+    ledger.recover()
+    threading.Thread(
+        target=ledger.run, args=(settings.INVENTORY_LEDGER_FLUSH_INTERVAL, threading.Event()), daemon=True
+    ).start()
+    return ledger
+
+
+def _running_ledger():
+    # the ledger of this process if the reservations have started it; elsewhere (e.g. in the sweep) the stock goes
+    # to the database, where the flushes of the owning process pick it up
+    if settings.INVENTORY_LEDGER_EVENTS and ledger.cache_info().currsize:
+        return ledger()
+    return None
+
+
+def _in_ledger(event_id):
+    return event_id in settings.INVENTORY_LEDGER_EVENTS
+
+
+@contextmanager
+def reserving():
+    # transaction of a reservation: the database gives back the stock of a rolled back reservation by itself,
+    # the ledger has to be told
+    taken = []
+    token = _taken.set(taken)
+    try:
+        with transaction.atomic():
+            yield
+    except BaseException:
+        for take, amounts in taken:
+            ledger().release(amounts, take)
+        raise
+    else:
+        for take, _ in taken:
+            ledger().settle(take)
+    finally:
+        _taken.reset(token)
+
+
+def _take(amounts):
+    taken = _taken.get()
+    take = ledger().reserve(amounts, confirmed=taken is not None)
+    if take is None:
+        return False
+    if taken is not None:
+        taken.append((take, amounts))
+        # commits with the reservation, which confirms the take to a restart
+        InventoryLedgerTake.objects.create(sequence=take)
+    return True
+
+
+def ticket_terms(ticket_id):
+    # AvailableTicket with the price, event and hold of the ticket (but not its stock), None if it doesn't exist;
+    # they rarely change, so reservations read them from the cache instead of the row they are about to lock
+    terms = caching.cached(caching.TICKET_TERMS, f'ticket:{ticket_id}', lambda: AvailableTicket.objects.filter(
+        pk=ticket_id
+    ).values('id', 'event_id', 'type', 'price', 'hold_minutes').first() or {})
+    return AvailableTicket(**terms) if terms else None
+
+
+def _decrement(ticket_id, amount):
+    # check and decrement in one conditional UPDATE, so concurrent buyers never oversell
+    updated = AvailableTicket.objects.filter(
+        pk=ticket_id, amount_of_tickets__gte=amount
+    ).update(amount_of_tickets=F('amount_of_tickets') - amount)
+    return updated == 1
+
+
+def _reserve(ticket, amount):
+    if _in_ledger(ticket.event_id):
+        return _take({ticket.id: amount})
+    return _decrement(ticket.id, amount)
+
+
+def reserve_tickets(ticket, amount):
+    reserved = _reserve(ticket, amount)
+    # expired holds may still block stock which the periodic sweep has not reclaimed yet
+    if not reserved and reclaim_expired_reservations(datetime.datetime.now(), ticket=ticket.id):
+        reserved = _reserve(ticket, amount)
+    if reserved:
+        stock_changed.send(sender=AvailableTicket, event_ids=[ticket.event_id])
+    return reserved
+
+
+def _decrement_many(amounts):
+    # one UPDATE for the whole basket; it rolls back unless every ticket had enough stock
+    amount = Case(*(When(pk=ticket_id, then=Value(n)) for ticket_id, n in amounts.items()),
+                  output_field=IntegerField())
+    with transaction.atomic():
+        updated = AvailableTicket.objects.filter(
+            pk__in=list(amounts), amount_of_tickets__gte=amount
+        ).update(amount_of_tickets=F('amount_of_tickets') - amount)
+        if updated != len(amounts):
+            raise InsufficientTicketsError()
+
+
+def _take_many(amounts):
+    if not _take(amounts):
+        raise InsufficientTicketsError()
+
+
+def reserve_many(tickets):
+    # reserves {ticket: amount} all or nothing
+    amounts = {ticket.id: amount for ticket, amount in tickets.items()}
+    decrement_many = _decrement_many
+    if all(_in_ledger(ticket.event_id) for ticket in tickets):
+        decrement_many = _take_many
+    try:
+        decrement_many(amounts)
+    except InsufficientTicketsError:
+        if not reclaim_expired_reservations(datetime.datetime.now(), ticket__in=list(amounts)):
+            return False
+        try:
+            decrement_many(amounts)
+        except InsufficientTicketsError:
+            return False
+    stock_changed.send(sender=AvailableTicket, event_ids={ticket.event_id for ticket in tickets})
+    return True
+
+
+def release_tickets(ticket_id, amount):
+    AvailableTicket.objects.filter(pk=ticket_id).update(amount_of_tickets=F('amount_of_tickets') + amount)
+
+
+def release_many(amounts):
+    # one aggregated UPDATE per ticket type instead of one per reservation; the ledger gets back its own tickets
+    running = _running_ledger()
+    if running is not None:
+        owned = running.available(amounts)
+        running.release({ticket_id: amounts[ticket_id] for ticket_id in owned})
+        amounts = {ticket_id: amount for ticket_id, amount in amounts.items() if ticket_id not in owned}
+    for ticket_id, amount in amounts.items():
+        release_tickets(ticket_id, amount)
+
+
+def current_amounts(tickets):
+    # AvailableTicket rows serialized with 'id' and 'amount_of_tickets', with the stock owned by the ledger
+    running = _running_ledger()
+    if running is not None:
+        owned = running.available([ticket['id'] for ticket in tickets])
+        for ticket in tickets:
+            ticket['amount_of_tickets'] = owned.get(ticket['id'], ticket['amount_of_tickets'])
+    return tickets
+
+
+def _reclaim_batch(expired, batch_size):
+    with transaction.atomic():
+        # rows locked by another sweeper are left to it, and the joined ticket rows stay free for buyers
+        batch = list(
+            expired.select_for_update(skip_locked=True, of=('self',)).order_by('expiration_datetime', 'pk')
+            .values_list('pk', 'ticket_id', 'ticket__event_id', 'amount_of_tickets', 'expiration_datetime', 'owner_id')
+            [:batch_size]
+        )
+        if not batch:
+            return batch
+        deleted, _ = TicketReservation.objects.filter(pk__in=[row[0] for row in batch]).delete()
+        if deleted != len(batch):
+            # somebody else has reclaimed a part of this batch in the meantime
+            raise ConcurrentReclaimError()
+        amounts = Counter()
+        for _, ticket_id, _, amount, _, _ in batch:
+            amounts[ticket_id] += amount
+        release_many(amounts)
+        stock_changed.send(sender=AvailableTicket, event_ids={row[2] for row in batch})
+        reservations_changed.send(sender=TicketReservation, owner_ids={row[5] for row in batch})
+    return batch
+
+
+def reclaim_expired_reservations(now, batch_size=RECLAIM_BATCH_SIZE, **filters):
+    # every expired reservation gives its tickets back exactly once, so it's safe to call this
+    # concurrently from the request path and from the periodic task
+    expired = TicketReservation.objects.filter(expiration_datetime__lt=now, **filters)
+    # an indexed read first, so callers with nothing to reclaim (most reads) never take the write lock
+    if not expired.exists():
+        return 0
+    reclaimed = 0
+    while True:
+        try:
+            batch = _reclaim_batch(expired, batch_size)
+        except ConcurrentReclaimError:
+            continue
+        if not batch:
+            return reclaimed
+        reclaimed += len(batch)
+        # reclaimed rows are gone, so the next batch starts where this one ended
+        expired = expired.filter(expiration_datetime__gte=batch[-1][4])
+
+
+def reclaim_due_buckets(now):
+    # the sweep visits only the expiry buckets which have come due, up to `now` in the current minute
+    reclaimed = 0
+    current = expiry.minute_of(now)
+    for minute in expiry.due_buckets(now):
+        start = expiry.start_of(minute)
+        end = start + expiry.BUCKET
+        reclaimed += reclaim_expired_reservations(min(end, now), expiration_datetime__gte=start)
+        # the current minute may still get reservations, and rows skipped while a concurrent sweeper held them
+        # keep the bucket for the next run
+        if minute < current and not TicketReservation.objects.filter(
+                expiration_datetime__gte=start, expiration_datetime__lt=end).exists():
+            ExpiryBucket.objects.filter(minute=minute).delete()
+    return reclaimed
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import threading
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import AvailableTicket, InventoryLedgerCheckpoint, InventoryLedgerTake
+from .signals import stock_changed
+
+logger = logging.getLogger(__name__)
+
+
+# Stock counters of the tickets of hot events owned by one process. Reservations are answered from memory and
+# every change is appended to a journal before it's acknowledged; the changes reach AvailableTicket in batched
+# flushes, together with the sequence of the last journal entry they cover, so a restart replays exactly the
+# entries the database hasn't seen yet.
+#
+# Entries of a take made for a reservation carry the take (the sequence of its first entry). The take is
+# confirmed by an InventoryLedgerTake row committed with the reservation, so a restart drops the takes of
+# reservations which never committed, and flushes wait for the takes whose transaction is still open.
+class Ledger:
+    def __init__(self, journal_path, fsync=True):
+        self.journal_path = str(journal_path)
+        self.fsync = fsync
+        self._amounts = {}
+        self._entries = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._journal = None
+        self._open = set()
+
+    def _checkpoint(self):
+        return InventoryLedgerCheckpoint.objects.get_or_create(pk=1)[0]
+
+    def _read_journal(self):
+        entries = []
+        if not os.path.exists(self.journal_path):
+            return entries
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    entries.append(tuple(json.loads(line)))
+                except ValueError:
+                    # the last line may be torn by a crash, it was never acknowledged
+                    break
+        return entries
+
+    def _apply(self, entries, sequence):
+        with transaction.atomic():
+            checkpoint = InventoryLedgerCheckpoint.objects.select_for_update().get(pk=1)
+            if checkpoint.sequence >= sequence:
+                return
+            deltas = Counter()
+            for entry in entries:
+                if entry[0] > checkpoint.sequence:
+                    deltas[entry[1]] += entry[2]
+            changed = [ticket_id for ticket_id, delta in deltas.items() if delta]
+            for ticket_id in changed:
+                AvailableTicket.objects.filter(pk=ticket_id).update(
+                    amount_of_tickets=F('amount_of_tickets') + deltas[ticket_id]
+                )
+            if changed:
+                # the live streams read AvailableTicket, which only now has the stock of the reservations
+                stock_changed.send(sender=AvailableTicket, event_ids=set(
+                    AvailableTicket.objects.filter(pk__in=changed).values_list('event_id', flat=True)
+                ))
+            checkpoint.sequence = sequence
+            checkpoint.save(update_fields=['sequence'])
+            InventoryLedgerTake.objects.filter(sequence__lte=sequence).delete()
+
+    def _rewrite_journal(self, entries):
+        with open(self.journal_path + '.tmp', 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self._journal is not None:
+            self._journal.close()
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+
+    def recover(self):
+        # replays the journal entries missing in the database and starts a new journal
+        checkpoint = self._checkpoint()
+        entries = [entry for entry in self._read_journal() if entry[0] > checkpoint.sequence]
+        takes = {entry[3] for entry in entries if len(entry) > 3}
+        confirmed = set(InventoryLedgerTake.objects.filter(sequence__in=takes).values_list('sequence', flat=True))
+        # the process died between the take and the commit of its reservation, so its tickets are still free
+        applied = [entry for entry in entries if len(entry) < 4 or entry[3] in confirmed]
+        if entries:
+            self._apply(applied, entries[-1][0])
+        self._sequence = max([checkpoint.sequence] + [entry[0] for entry in entries])
+        with self._lock:
+            self._amounts.clear()
+            self._entries = []
+            self._open.clear()
+            self._rewrite_journal([])
+        return len(applied)
+
+    def _append(self, changes, take=None):
+        for ticket_id, delta in changes:
+            self._sequence += 1
+            entry = (self._sequence, ticket_id, delta) if take is None else (self._sequence, ticket_id, delta, take)
+            self._entries.append(entry)
+            self._journal.write(json.dumps(entry) + '\n')
+            self._amounts[ticket_id] += delta
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _load(self, ticket_ids):
+        missing = [ticket_id for ticket_id in ticket_ids if ticket_id not in self._amounts]
+        if missing:
+            pending = self._pending()
+            for ticket_id, amount in AvailableTicket.objects.filter(pk__in=missing).values_list('id', 'amount_of_tickets'):
+                self._amounts[ticket_id] = amount + pending[ticket_id]
+
+    def _pending(self):
+        pending = Counter()
+        for entry in self._entries:
+            pending[entry[1]] += entry[2]
+        return pending
+
+    def reserve(self, amounts, confirmed=False):
+        # takes {ticket_id: amount} all or nothing and returns the take, None if there aren't enough tickets;
+        # a `confirmed` take stays open until it's settled or released
+        with self._lock:
+            self._load(amounts)
+            if any(self._amounts.get(ticket_id, 0) < amount for ticket_id, amount in amounts.items()):
+                return None
+            take = self._sequence + 1
+            self._append(((ticket_id, -amount) for ticket_id, amount in amounts.items()), take if confirmed else None)
+            if confirmed:
+                self._open.add(take)
+            return take
+
+    def settle(self, take):
+        # the reservation of the take has committed
+        with self._lock:
+            self._open.discard(take)
+
+    def release(self, amounts, take=None):
+        # `take` ties the tickets given back by a rolled back take to it, so a restart drops both if the take
+        # was never confirmed
+        with self._lock:
+            self._load(amounts)
+            self._append(((ticket_id, amount) for ticket_id, amount in amounts.items() if ticket_id in self._amounts),
+                         take)
+            self._open.discard(take)
+
+    def available(self, ticket_ids):
+        with self._lock:
+            return {ticket_id: self._amounts[ticket_id] for ticket_id in ticket_ids if ticket_id in self._amounts}
+
+    def flush(self):
+        # writes the journalled changes to AvailableTicket and reconciles the counters with it, so changes made
+        # directly in the database (e.g. by an import) are picked up
+        with self._flush_lock:
+            with self._lock:
+                # reservations keep appending while the snapshot is applied, and entries of open takes (with
+                # everything after them) wait for their transaction
+                entries = [entry for entry in self._entries if not self._open or entry[0] < min(self._open)]
+                ticket_ids = list(self._amounts)
+            if entries:
+                self._apply(entries, entries[-1][0])
+            amounts = dict(AvailableTicket.objects.filter(pk__in=ticket_ids).values_list('id', 'amount_of_tickets'))
+            with self._lock:
+                if entries:
+                    self._entries = [entry for entry in self._entries if entry[0] > entries[-1][0]]
+                    self._rewrite_journal(self._entries)
+                pending = self._pending()
+                for ticket_id in ticket_ids:
+                    if ticket_id in amounts:
+                        self._amounts[ticket_id] = amounts[ticket_id] + pending[ticket_id]
+                    else:
+                        del self._amounts[ticket_id]
+            return len(entries)
+
+    def run(self, interval, stop):
+        while not stop.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                # e.g. the database was locked for longer than its timeout; the entries stay in the journal and
+                # the next flush writes them
+                logger.exception('Flushing the inventory ledger failed')
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import re
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import AvailableTicket
+
+STREAM_PATH = re.compile(r'^/api/event/(?P<event_id>\d+)/available_tickets/stream$')
+
+
+class Broadcaster:
+    # fans out the stock of events to their subscribers in one process: changes are coalesced per event over
+    # LIVE_AVAILABILITY_COALESCE seconds and read once for all the subscribers
+    def __init__(self):
+        self._subscribers = {}
+        self._amounts = {}
+        self._loading = {}
+        self._dirty = set()
+        self._flush_scheduled = False
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _read(self, event_ids):
+        amounts = {event_id: {} for event_id in event_ids}
+        for event_id, ticket_id, type_, amount in AvailableTicket.objects.filter(event_id__in=event_ids).values_list(
+                'event_id', 'id', 'type', 'amount_of_tickets'):
+            amounts[event_id][ticket_id] = (type_, amount)
+        return amounts
+
+    async def subscribe(self, event_id):
+        # returns the queue of the updates and the current stock, None if the event has no tickets
+        self._loop = asyncio.get_running_loop()
+        if event_id not in self._amounts:
+            # the event is subscribed before its stock is read, so a change committed during the read is
+            # flushed once the read is done
+            subscribers = self._subscribers.setdefault(event_id, set())
+            # subscribers arriving together share the read
+            if event_id not in self._loading:
+                self._loading[event_id] = asyncio.ensure_future(
+                    sync_to_async(self._read, thread_sensitive=True)([event_id])
+                )
+            try:
+                amounts = (await self._loading[event_id])[event_id]
+            except BaseException:
+                if not subscribers:
+                    self._subscribers.pop(event_id, None)
+                raise
+            finally:
+                self._loading.pop(event_id, None)
+            self._amounts.setdefault(event_id, amounts)
+        if not self._amounts[event_id]:
+            if not self._subscribers.get(event_id):
+                self._subscribers.pop(event_id, None)
+                self._amounts.pop(event_id, None)
+            return None, None
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(event_id, set()).add(queue)
+        return queue, _tickets(self._amounts[event_id])
+
+    def unsubscribe(self, event_id, queue):
+        subscribers = self._subscribers.get(event_id, set())
+        subscribers.discard(queue)
+        if not subscribers:
+            self._subscribers.pop(event_id, None)
+            self._amounts.pop(event_id, None)
+
+    def notify(self, event_ids):
+        # called from any thread once the change is committed
+        event_ids = [event_id for event_id in event_ids if event_id in self._subscribers]
+        with self._lock:
+            if not event_ids:
+                return
+            self._dirty.update(event_ids)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self._loop.call_soon_threadsafe(lambda: asyncio.ensure_future(self._flush()))
+
+    async def _flush(self):
+        await asyncio.sleep(settings.LIVE_AVAILABILITY_COALESCE)
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            self._flush_scheduled = False
+        # events whose stock is still being read wait for another flush
+        loading = [event_id for event_id in dirty if event_id in self._subscribers and event_id not in self._amounts]
+        if loading:
+            self.notify(loading)
+        event_ids = [event_id for event_id in dirty if event_id in self._subscribers and event_id in self._amounts]
+        if not event_ids:
+            return
+        for event_id, amounts in (await sync_to_async(self._read, thread_sensitive=True)(event_ids)).items():
+            previous = self._amounts.get(event_id)
+            if event_id not in self._subscribers or previous is None:
+                continue
+            self._amounts[event_id] = amounts
+            changes = [
+                dict(ticket, delta=ticket['amount_of_tickets'] - previous.get(ticket['id'], (None, 0))[1])
+                for ticket in _tickets(amounts) if previous.get(ticket['id']) != amounts[ticket['id']]
+            ]
+            if changes:
+                for queue in self._subscribers[event_id]:
+                    queue.put_nowait(changes)
+
+
+def _tickets(amounts):
+    return [
+        {'id': ticket_id, 'type': type_, 'amount_of_tickets': amount}
+        for ticket_id, (type_, amount) in sorted(amounts.items())
+    ]
+
+
+broadcaster = Broadcaster()
+
+
+def _message(event, data):
+    return {'type': 'http.response.body', 'body': f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode(),
+            'more_body': True}
+
+
+async def _disconnected(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def availability_stream(scope, receive, send, event_id):
+    # server-sent events: the current stock of the event, then the changed tickets with their deltas
+    queue, tickets = await broadcaster.subscribe(event_id)
+    if queue is None:
+        await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': b'{}'})
+        return
+    disconnected = asyncio.ensure_future(_disconnected(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await send(_message('snapshot', tickets))
+        while not disconnected.done():
+            update = asyncio.ensure_future(queue.get())
+            await asyncio.wait({update, disconnected}, timeout=settings.LIVE_AVAILABILITY_KEEPALIVE,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if update.done():
+                await send(_message('update', update.result()))
+            else:
+                update.cancel()
+                if not disconnected.done():
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+    finally:
+        disconnected.cancel()
+        broadcaster.unsubscribe(event_id, queue)
+
+
+def application(django_application):
+    # raw ASGI in front of Django, which can't hold a streaming response open on every connection cheaply
+    async def app(scope, receive, send):
+        if scope['type'] == 'http':
+            match = STREAM_PATH.match(scope['path'])
+            if match:
+                return await availability_stream(scope, receive, send, int(match['event_id']))
+        return await django_application(scope, receive, send)
+    return app
@@ -0,0 +1,59 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from tickets_component import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Runs the API benchmarks against a fresh test database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', help=f'any of: {", ".join(benchmarks.SCENARIOS)} (default all)')
+        parser.add_argument('--requests', type=int, default=200, help='requests sent per measurement')
+        parser.add_argument('--concurrency', type=int, default=8, help='clients sending the requests at once')
+        parser.add_argument('--events', type=int, default=10000, help='events seeded before the endpoints run')
+        parser.add_argument('--reservations', type=int, default=1000000, help='reservations seeded')
+        parser.add_argument('--purchases', type=int, default=1000000, help='purchased tickets seeded')
+        parser.add_argument('--save-baseline', metavar='PATH', help='store the results as the baseline')
+        parser.add_argument('--compare', metavar='PATH', help='fail on regressions against a stored baseline')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='allowed relative growth of p95 latency and queries per request (default 0.2)')
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenarios']) - benchmarks.SCENARIOS.keys()
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        results = {}
+        try:
+            with benchmarks.benchmark_environment():
+                for name in options['scenarios'] or benchmarks.SCENARIOS:
+                    self.stdout.write(self.style.MIGRATE_HEADING(name))
+                    results[name] = benchmarks.SCENARIOS[name](options)
+                    for result in results[name]:
+                        self.stdout.write('  ' + ', '.join(
+                            f'{k}: {v:.3f}' if isinstance(v, float) else f'{k}: {v}' for k, v in result.items()
+                        ))
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump({name: {r['name']: r for r in scenario_results} for name, scenario_results in results.items()},
+                          f, indent=2)
+        if baseline is not None:
+            regressions = benchmarks.compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline.'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from tickets_component import transfer
+
+
+class Command(BaseCommand):
+    help = 'Exports the stock of tickets or the purchases as CSV or JSONL, streamed row by row.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=transfer.EXPORTS)
+        parser.add_argument('--format', choices=transfer.FORMATS, help='defaults to the extension of the output')
+        parser.add_argument('--output', help='file to write (default stdout)')
+
+    def handle(self, *args, **options):
+        format_ = options['format'] or (transfer.format_of(options['output']) if options['output'] else 'csv')
+        _, fields = transfer.EXPORTS[options['kind']]
+        rows = transfer.export_rows(options['kind'])
+        if options['output'] is None:
+            transfer.write_rows(rows, fields, format_, self.stdout)
+            return
+        with open(options['output'], 'w', newline='') as f:
+            transfer.write_rows(rows, fields, format_, f)
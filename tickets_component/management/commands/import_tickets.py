@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tickets_component import transfer
+
+
+class Command(BaseCommand):
+    help = 'Imports events and their ticket tiers (event, datetime, type, price, amount_of_tickets) from CSV or JSONL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='.csv or .jsonl file')
+        parser.add_argument('--format', choices=transfer.FORMATS, help='defaults to the extension of the file')
+        parser.add_argument('--batch-size', type=int, default=transfer.IMPORT_BATCH_SIZE, help='rows per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='only validate the file')
+        parser.add_argument('--replace-stock', action='store_true',
+                            help='overwrite the stock of existing tiers, giving back the tickets held or sold since')
+
+    def handle(self, *args, **options):
+        format_ = options['format'] or transfer.format_of(options['path'])
+        try:
+            with open(options['path'], newline='') as f:
+                events, created, updated = transfer.import_tiers(
+                    transfer.read_rows(f, format_), options['batch_size'], options['dry_run'], options['replace_stock']
+                )
+        except (OSError, ValueError, transfer.InvalidRowError) as ex:
+            raise CommandError(str(ex))
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS('The file is valid.'))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {events} events and {created} ticket tiers, updated {updated} ticket tiers.'
+        ))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from tickets_component import rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the purchased tickets statistics from the purchases, or checks them with --check.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='only compare the statistics with the purchases')
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            rollups.rebuild_purchased_statistics()
+            self.stdout.write(self.style.SUCCESS('Purchased tickets statistics rebuilt.'))
+            return
+        inconsistencies = rollups.check_purchased_statistics()
+        for (event_id, type_), (rollup, raw) in sorted(inconsistencies.items()):
+            self.stdout.write(f'event {event_id}, type {type_}: statistics {rollup}, purchases {raw}')
+        if inconsistencies:
+            raise CommandError(f'{len(inconsistencies)} inconsistent purchased tickets statistics.')
+        self.stdout.write(self.style.SUCCESS('Purchased tickets statistics are consistent.'))
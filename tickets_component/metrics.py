@@ -0,0 +1,189 @@
+import asyncio
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+MILLISECONDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+COUNTS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SLOW_REQUEST_MAX_QUERIES = 100
+
+# timings of the request being handled, shared with the timers of the code it calls
+_current = ContextVar('tickets_request_metrics', default=None)
+# statements of the request being handled, kept for the slow request samples
+_statements = ContextVar('tickets_request_statements', default=None)
+
+
+class Histogram:
+    # fixed buckets, so recording is a bisect and an increment and the memory never grows
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the percentile (None above the last bound)
+        rank = self.count * p / 100
+        seen = 0
+        for bound, bucket in zip(self.bounds + (None,), self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return bound
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+_lock = threading.Lock()
+_histograms = {}
+_slow_requests = deque(maxlen=settings.METRICS_SLOW_REQUEST_SAMPLES)
+
+
+def observe(endpoint, name, value):
+    with _lock:
+        histogram = _histograms.get((endpoint, name))
+        if histogram is None:
+            histogram = _histograms[(endpoint, name)] = Histogram(COUNTS if name == 'queries' else MILLISECONDS)
+        histogram.observe(value)
+
+
+@contextmanager
+def timer(name):
+    # adds the time spent in the block to the current request, or to the background work outside of requests
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        timings = _current.get()
+        if timings is None:
+            observe('background', name, elapsed)
+        else:
+            timings[name] = timings.get(name, 0) + elapsed
+
+
+def snapshot():
+    with _lock:
+        endpoints = {}
+        for (endpoint, name), histogram in sorted(_histograms.items()):
+            endpoints.setdefault(endpoint, {})[name] = histogram.snapshot()
+        return {'endpoints': endpoints, 'slow_requests': list(_slow_requests)}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _slow_requests.clear()
+
+
+def _execute(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        timings['queries'] += 1
+        timings['db'] += elapsed
+        statements = _statements.get()
+        if len(statements) < SLOW_REQUEST_MAX_QUERIES:
+            statements.append({'sql': sql, 'ms': elapsed})
+
+
+def _instrument(connection, **kwargs):
+    # every connection of every thread (the sync views of an ASGI request run in a worker thread, the reads
+    # routed to the replicas use their own connections) measures the queries of the request it serves
+    if _execute not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute)
+
+
+connection_created.connect(_instrument)
+
+
+class MetricsMiddleware:
+    # records the latency, query count and DB time of every endpoint, plus the gateway and render time of its
+    # timers; the SQL of requests slower than METRICS_SLOW_REQUEST_THRESHOLD is kept as a sample
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # served as a coroutine under ASGI, so the async views aren't run through the sync handler
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        # the connections opened before this module was imported
+        for connection in connections.all():
+            _instrument(connection)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self._acall(request)
+        state = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            self._stop(state)
+        return self._record(request, response, state)
+
+    async def _acall(self, request):
+        state = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            self._stop(state)
+        return self._record(request, response, state)
+
+    def _start(self):
+        timings, statements = {'queries': 0, 'db': 0}, []
+        return timings, statements, _current.set(timings), _statements.set(statements), time.perf_counter()
+
+    def _stop(self, state):
+        _current.reset(state[2])
+        _statements.reset(state[3])
+
+    def _record(self, request, response, state):
+        timings, statements, _, _, started = state
+        timings['total'] = (time.perf_counter() - started) * 1000
+
+        match = request.resolver_match
+        endpoint = f'{request.method} {match.route if match else "unresolved"}'
+        for name, value in timings.items():
+            observe(endpoint, name, value)
+        if timings['total'] >= settings.METRICS_SLOW_REQUEST_THRESHOLD * 1000:
+            with _lock:
+                _slow_requests.append({
+                    'endpoint': endpoint, 'path': request.path, 'status': response.status_code,
+                    'timings': timings, 'queries': statements,
+                })
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook, which tells serialization apart from the view
+        timings = _current.get()
+        started = time.perf_counter()
+
+        def rendered(response):
+            if timings is not None:
+                timings['render'] = (time.perf_counter() - started) * 1000
+        response.add_post_render_callback(rendered)
+        return response
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0002_auto_20201024_1936'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='availableticket',
+            index=models.Index(fields=['event', 'type'], name='tickets_com_event_i_5b4550_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticketreservation',
+            index=models.Index(fields=['expiration_datetime'], name='tickets_com_expirat_a4bdfd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticketreservation',
+            index=models.Index(fields=['owner', 'expiration_datetime'], name='tickets_com_owner_i_2b2895_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticketreservation',
+            index=models.Index(fields=['ticket', 'expiration_datetime'], name='tickets_com_ticket__af3e7e_idx'),
+        ),
+    ]
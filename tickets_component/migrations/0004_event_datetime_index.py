@@ -0,0 +1,17 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0003_reservation_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['datetime', 'id'], name='tickets_com_datetim_98e0ad_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:43
+
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def fill_purchased_statistics(apps, schema_editor):
+    PurchasedTicket = apps.get_model('tickets_component', 'PurchasedTicket')
+    PurchasedTicketStatistic = apps.get_model('tickets_component', 'PurchasedTicketStatistic')
+    totals = PurchasedTicket.objects.values_list('ticket__event_id', 'ticket__type').annotate(
+        quantity=Sum('amount_of_tickets'))
+    PurchasedTicketStatistic.objects.bulk_create([
+        PurchasedTicketStatistic(event_id=event_id, type=type_, amount_of_tickets=quantity)
+        for event_id, type_, quantity in totals
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0004_event_datetime_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PurchasedTicketStatistic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('r', 'regular'), ('p', 'premium'), ('V', 'VIP')], max_length=1)),
+                ('amount_of_tickets', models.IntegerField(default=0)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='tickets_component.event')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='purchasedticketstatistic',
+            constraint=models.UniqueConstraint(fields=('event', 'type'), name='unique_purchased_statistic'),
+        ),
+        migrations.RunPython(fill_purchased_statistics, migrations.RunPython.noop),
+    ]
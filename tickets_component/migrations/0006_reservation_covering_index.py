@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0005_purchased_ticket_statistic'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ticketreservation',
+            index=models.Index(fields=['expiration_datetime', 'ticket', 'amount_of_tickets'], name='tickets_com_expirat_ef1d21_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='ticketreservation',
+            name='tickets_com_expirat_a4bdfd_idx',
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.2 on 2026-10-18 13:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0008_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryLedgerCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.2 on 2026-10-18 13:12
+
+from django.db import migrations, models
+
+
+def fill_expiry_buckets(apps, schema_editor):
+    TicketReservation = apps.get_model('tickets_component', 'TicketReservation')
+    ExpiryBucket = apps.get_model('tickets_component', 'ExpiryBucket')
+    minutes = {
+        int(expiration_datetime.timestamp() // 60)
+        for expiration_datetime in TicketReservation.objects.values_list('expiration_datetime', flat=True).distinct()
+    }
+    ExpiryBucket.objects.bulk_create([ExpiryBucket(minute=minute) for minute in minutes])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0009_inventory_ledger_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpiryBucket',
+            fields=[
+                ('minute', models.BigIntegerField(primary_key=True, serialize=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='availableticket',
+            name='hold_minutes',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='ticketreservation',
+            name='extensions',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_expiry_buckets, migrations.RunPython.noop),
+    ]
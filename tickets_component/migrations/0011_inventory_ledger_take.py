@@ -0,0 +1,19 @@
+# Generated by Django 3.1.2 on 2026-10-18 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0010_expiry_buckets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryLedgerTake',
+            fields=[
+                ('sequence', models.BigIntegerField(primary_key=True, serialize=False)),
+            ],
+        ),
+    ]
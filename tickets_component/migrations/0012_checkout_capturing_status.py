@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-18 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0011_inventory_ledger_take'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='checkout',
+            name='status',
+            field=models.CharField(choices=[('pending', 'pending'), ('capturing', 'capturing'), ('succeeded', 'succeeded'), ('failed', 'failed')], default='pending', max_length=9),
+        ),
+    ]
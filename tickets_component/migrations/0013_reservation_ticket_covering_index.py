@@ -0,0 +1,29 @@
+# Generated by Django 3.1.2 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0012_checkout_capturing_status'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='ticketreservation',
+            name='tickets_com_ticket__af3e7e_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='ticketreservation',
+            name='tickets_com_expirat_ef1d21_idx',
+        ),
+        migrations.AddIndex(
+            model_name='ticketreservation',
+            index=models.Index(fields=['expiration_datetime'], name='tickets_com_expirat_a4bdfd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticketreservation',
+            index=models.Index(fields=['ticket', 'expiration_datetime', 'amount_of_tickets'], name='tickets_com_ticket__6e5a9a_idx'),
+        ),
+    ]
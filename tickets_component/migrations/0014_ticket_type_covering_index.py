@@ -0,0 +1,21 @@
+# Generated by Django 3.1.2 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets_component', '0013_reservation_ticket_covering_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='availableticket',
+            name='tickets_com_event_i_5b4550_idx',
+        ),
+        migrations.AddIndex(
+            model_name='availableticket',
+            index=models.Index(fields=['type', 'event', 'amount_of_tickets'], name='tickets_com_type_a6a342_idx'),
+        ),
+    ]
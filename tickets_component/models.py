@@ -1,3 +1,5 @@
+import datetime
+
 from django.db import models
 from django.conf import settings
 
@@ -7,18 +9,44 @@ TICKET_TYPES = [
     ('p', 'premium'),
     ('V', 'VIP')
 ]
+CHECKOUT_STATUSES = [
+    ('pending', 'pending'),
+    ('capturing', 'capturing'),
+    ('succeeded', 'succeeded'),
+    ('failed', 'failed'),
+]
 
 
 class Event(models.Model):
     name = models.CharField(max_length=50)
     datetime = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['datetime', 'id']),
+        ]
+
 
 class AvailableTicket(models.Model):
     event = models.ForeignKey(Event, on_delete=models.CASCADE)
     amount_of_tickets = models.IntegerField()
     type = models.CharField(choices=TICKET_TYPES, max_length=1)
     price = models.DecimalField(max_digits=6, decimal_places=2)
+    # how long reservations of these tickets are held, RESERVATION_HOLD_DURATION if not set
+    hold_minutes = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # the statistics of a type (of an event) are summed from the index alone, the tickets of an event
+            # use the index of its foreign key
+            models.Index(fields=['type', 'event', 'amount_of_tickets']),
+        ]
+
+    @property
+    def hold_duration(self):
+        if self.hold_minutes is None:
+            return settings.RESERVATION_HOLD_DURATION
+        return datetime.timedelta(minutes=self.hold_minutes)
 
 
 class TicketReservation(models.Model):
@@ -27,9 +55,72 @@ class TicketReservation(models.Model):
     amount_of_tickets = models.IntegerField()
     amount_to_pay = models.DecimalField(max_digits=8, decimal_places=2)
     expiration_datetime = models.DateTimeField()
+    checkout = models.ForeignKey('Checkout', null=True, blank=True, on_delete=models.SET_NULL)
+    extensions = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expiration_datetime']),
+            models.Index(fields=['owner', 'expiration_datetime']),
+            # covers the reclaim on the reserve path and the reserved tickets statistics summed per ticket
+            models.Index(fields=['ticket', 'expiration_datetime', 'amount_of_tickets']),
+        ]
 
 
 class PurchasedTicket(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE)
     ticket = models.ForeignKey(AvailableTicket, on_delete=models.CASCADE)
     amount_of_tickets = models.IntegerField()
+
+
+class Checkout(models.Model):
+    # payment accepted by the API and captured in the background by the `capture_payment` task
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3)
+    token = models.CharField(max_length=255, blank=True)
+    status = models.CharField(choices=CHECKOUT_STATUSES, max_length=9, default='pending')
+    message = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class PurchasedTicketStatistic(models.Model):
+    # rollup of PurchasedTicket maintained on every purchase, so statistics don't scan all the purchases
+    event = models.ForeignKey(Event, on_delete=models.CASCADE)
+    type = models.CharField(choices=TICKET_TYPES, max_length=1)
+    amount_of_tickets = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['event', 'type'], name='unique_purchased_statistic'),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    # response of a request sent with the `Idempotency-Key` header, replayed when the request is retried
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    path = models.CharField(max_length=255)
+    status_code = models.IntegerField(null=True)
+    response = models.JSONField(null=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'key'], name='unique_idempotency_key'),
+        ]
+
+
+class InventoryLedgerCheckpoint(models.Model):
+    # sequence of the last journal entry of the in-memory inventory ledger applied to AvailableTicket
+    sequence = models.BigIntegerField(default=0)
+
+
+class InventoryLedgerTake(models.Model):
+    # ledger take committed together with its reservation, kept until the checkpoint covers it
+    sequence = models.BigIntegerField(primary_key=True)
+
+
+class ExpiryBucket(models.Model):
+    # minute (since the epoch) in which some reservations expire; the sweeper only visits the minutes gone by
+    minute = models.BigIntegerField(primary_key=True)
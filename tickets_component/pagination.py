@@ -0,0 +1,36 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.db.models import Q
+from rest_framework.utils.encoders import JSONEncoder
+
+STREAM_CHUNK_SIZE = 500
+
+
+def encode_cursor(event):
+    raw = f'{event.datetime.isoformat()}|{event.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        dt, pk = raw.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(dt), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+
+def after_cursor(events, cursor):
+    # keyset condition matching the ('datetime', 'id') ordering, so deep pages cost the same as the first one
+    dt, pk = cursor
+    return events.filter(Q(datetime__gt=dt) | Q(datetime=dt, id__gt=pk))
+
+
+def stream_json(queryset, serializer_class):
+    yield '['
+    for i, obj in enumerate(queryset.iterator(chunk_size=STREAM_CHUNK_SIZE)):
+        yield (',' if i else '') + json.dumps(serializer_class(obj).data, cls=JSONEncoder)
+    yield ']'
@@ -1,4 +1,8 @@
+import asyncio
+import weakref
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 
 class CardError(Exception):
@@ -19,7 +23,8 @@ PaymentResult = namedtuple('PaymentResult', ('amount', 'currency'))
 class PaymentGateway:
     supported_currencies = ('EUR',)
 
-    def charge(self, amount, token, currency='EUR'):
+    def charge(self, amount, token, currency='EUR', reference=None):
+        # `reference` is the idempotency key of the provider: a charge retried with it isn't taken twice
         if token == 'card_error':
             raise CardError("Your card has been declined")
         elif token == 'payment_error':
@@ -28,3 +33,53 @@ class PaymentGateway:
             raise CurrencyError(f"Currency {currency} not supported")
         else:
             return PaymentResult(amount, currency)
+
+
+class PaymentTimeoutError(PaymentError):
+    pass
+
+
+class AsyncPaymentGateway:
+    supported_currencies = ('EUR',)
+
+    def __init__(self, timeout=10, max_concurrency=50):
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        # asyncio primitives belong to a loop, so every loop using the shared gateway gets its own semaphore
+        self._semaphores = weakref.WeakKeyDictionary()
+        # the provider's client blocks, so it runs in threads of its own while the loop keeps serving; one client
+        # (with its connections) is shared by all the charges
+        self._client = PaymentGateway()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='payment-gateway')
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    async def charge(self, amount, token, currency='EUR', reference=None):
+        # on a timeout the charge keeps running in its thread and may still be taken, so it must be retried with
+        # the same `reference`
+        async with self._semaphore():
+            try:
+                return await asyncio.wait_for(self._charge(amount, token, currency, reference), self.timeout)
+            except asyncio.TimeoutError:
+                raise PaymentTimeoutError("Payment gateway didn't respond in time")
+
+    async def _charge(self, amount, token, currency, reference):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(self._client.charge, amount, token, currency, reference=reference)
+        )
+
+
+class FakePaymentGateway(AsyncPaymentGateway):
+    # local stand-in for the provider, simulating its network latency for benchmarks
+
+    def __init__(self, latency=0.1, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    async def _charge(self, amount, token, currency, reference):
+        await asyncio.sleep(self.latency)
+        return await super()._charge(amount, token, currency, reference)
@@ -0,0 +1,54 @@
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+
+from .models import PurchasedTicket, PurchasedTicketStatistic
+
+
+def _add(event_id, type_, amount):
+    statistic = PurchasedTicketStatistic.objects.filter(event_id=event_id, type=type_)
+    if statistic.update(amount_of_tickets=F('amount_of_tickets') + amount):
+        return
+    try:
+        with transaction.atomic():
+            PurchasedTicketStatistic.objects.create(event_id=event_id, type=type_, amount_of_tickets=amount)
+    except IntegrityError:
+        # a concurrent purchase has created the row first
+        statistic.update(amount_of_tickets=F('amount_of_tickets') + amount)
+
+
+def record_purchases(purchased_tickets):
+    amounts = Counter()
+    for purchased in purchased_tickets:
+        amounts[purchased.ticket.event_id, purchased.ticket.type] += purchased.amount_of_tickets
+    for (event_id, type_), amount in amounts.items():
+        _add(event_id, type_, amount)
+
+
+def purchased_totals():
+    totals = PurchasedTicket.objects.values_list('ticket__event_id', 'ticket__type').annotate(
+        quantity=Sum('amount_of_tickets'))
+    return {(event_id, type_): quantity for event_id, type_, quantity in totals}
+
+
+def rebuild_purchased_statistics():
+    with transaction.atomic():
+        PurchasedTicketStatistic.objects.all().delete()
+        PurchasedTicketStatistic.objects.bulk_create([
+            PurchasedTicketStatistic(event_id=event_id, type=type_, amount_of_tickets=quantity)
+            for (event_id, type_), quantity in purchased_totals().items()
+        ])
+
+
+def check_purchased_statistics():
+    # returns {(event_id, type): (rollup, raw)} for every inconsistent pair
+    rollup = {
+        (event_id, type_): quantity for event_id, type_, quantity
+        in PurchasedTicketStatistic.objects.values_list('event_id', 'type', 'amount_of_tickets')
+    }
+    raw = purchased_totals()
+    return {
+        key: (rollup.get(key, 0), raw.get(key, 0))
+        for key in rollup.keys() | raw.keys() if rollup.get(key, 0) != raw.get(key, 0)
+    }
@@ -0,0 +1,75 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+
+# set while a read-only view runs, the only time reads may be served by a replica
+_replica_reads = ContextVar('tickets_replica_reads', default=False)
+
+
+def _pin_key(user_id):
+    return f'tickets:primary:{user_id}'
+
+
+def pin_to_primary(user_id):
+    # the user who has just written reads from the primary until the replicas have caught up
+    cache.set(_pin_key(user_id), True, timeout=settings.READ_YOUR_WRITES_WINDOW)
+
+
+def is_pinned(user_id):
+    return user_id is not None and cache.get(_pin_key(user_id)) is not None
+
+
+def replica_reads(view):
+    # must be applied below @api_view, so the request is already authenticated
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not settings.REPLICA_DATABASES or is_pinned(request.user.id):
+            return view(request, *args, **kwargs)
+        token = _replica_reads.set(True)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+    return wrapper
+
+
+@contextmanager
+def primary_reads():
+    # reads of the block go to the primary even in a read-only view, e.g. around its writes
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def pins_primary(view):
+    # must be applied below @api_view, so the request is already authenticated
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if response.status_code < 400:
+            pin_to_primary(request.user.id)
+        return response
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and settings.REPLICA_DATABASES:
+            return random.choice(settings.REPLICA_DATABASES)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db not in settings.REPLICA_DATABASES
@@ -1,7 +1,9 @@
 from rest_framework import serializers
+from django.conf import settings
 import datetime
 
-from .models import Event, AvailableTicket, TicketReservation, PurchasedTicket
+from .models import Event, AvailableTicket, TicketReservation, PurchasedTicket, Checkout, TICKET_TYPES
+from . import pagination, inventory
 
 
 class EventSerializer(serializers.ModelSerializer):
@@ -10,13 +12,41 @@ class EventSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'datetime']
 
 
+class EventListQuerySerializer(serializers.Serializer):
+    cursor = serializers.CharField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=settings.EVENTS_MAX_PAGE_SIZE,
+                                     default=settings.EVENTS_PAGE_SIZE)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    stream = serializers.BooleanField(default=False)
+
+    def validate_cursor(self, value):
+        try:
+            return pagination.decode_cursor(value)
+        except ValueError:
+            raise serializers.ValidationError('Invalid cursor.')
+
+
 class AvailableTicketSerializer(serializers.ModelSerializer):
     class Meta:
         model = AvailableTicket
         fields = ['id', 'event_id', 'type', 'amount_of_tickets', 'price']
 
 
+class CachedTicketField(serializers.PrimaryKeyRelatedField):
+    # the ticket comes from inventory.ticket_terms, so validating a reservation doesn't read its row
+    def to_internal_value(self, data):
+        try:
+            ticket = inventory.ticket_terms(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if ticket is None:
+            self.fail('does_not_exist', pk_value=data)
+        return ticket
+
+
 class TicketReservationSerializer(serializers.ModelSerializer):
+    ticket = CachedTicketField(queryset=AvailableTicket.objects.all())
     amount_to_pay = serializers.DecimalField(max_digits=8, decimal_places=2, default=None)
     expiration_datetime = serializers.DateTimeField(default=None)
     event = serializers.SerializerMethodField(read_only=True, default=0)
@@ -26,7 +56,8 @@ class TicketReservationSerializer(serializers.ModelSerializer):
         fields = ['id', 'ticket', 'event', 'amount_of_tickets', 'amount_to_pay', 'expiration_datetime']
 
     def get_event(self, obj):
-        return AvailableTicket.objects.get(pk=obj.ticket.id).event_id
+        # querysets of reservations should select_related('ticket') to avoid a query per row
+        return obj.ticket.event_id
 
     def validate_amount_of_tickets(self, value):
         if value < 0 or value > 10:
@@ -34,13 +65,13 @@ class TicketReservationSerializer(serializers.ModelSerializer):
         return value
 
     def validate(self, data):
-        t = AvailableTicket.objects.get(pk=data['ticket'].id)
+        t = data['ticket']
 
         if data['amount_to_pay'] is None:
             data['amount_to_pay'] = t.price * data['amount_of_tickets']
 
         if data['expiration_datetime'] is None:
-            data['expiration_datetime'] = datetime.datetime.now() + datetime.timedelta(minutes=15)
+            data['expiration_datetime'] = datetime.datetime.now() + t.hold_duration
 
         if t.price * data['amount_of_tickets'] != data['amount_to_pay']:
             raise serializers.ValidationError(
@@ -49,13 +80,75 @@ class TicketReservationSerializer(serializers.ModelSerializer):
         return data
 
 
+RESERVATION_ROW_FIELDS = (
+    'id', 'ticket_id', 'ticket__event_id', 'amount_of_tickets', 'amount_to_pay', 'expiration_datetime'
+)
+
+
+def represent_reservations(rows):
+    # TicketReservationSerializer output for values(*RESERVATION_ROW_FIELDS) rows, without a serializer per row
+    fields = TicketReservationSerializer().fields
+    amount_to_pay = fields['amount_to_pay'].to_representation
+    expiration_datetime = fields['expiration_datetime'].to_representation
+    return [{
+        'id': row['id'],
+        'ticket': row['ticket_id'],
+        'event': row['ticket__event_id'],
+        'amount_of_tickets': row['amount_of_tickets'],
+        'amount_to_pay': amount_to_pay(row['amount_to_pay']),
+        'expiration_datetime': expiration_datetime(row['expiration_datetime']),
+    } for row in rows]
+
+
+class BasketItemSerializer(serializers.Serializer):
+    ticket = serializers.IntegerField()
+    amount_of_tickets = serializers.IntegerField(min_value=1, max_value=10)
+
+
+class BasketReservationSerializer(serializers.Serializer):
+    tickets = BasketItemSerializer(many=True, allow_empty=False)
+
+    def validate_tickets(self, value):
+        if len({item['ticket'] for item in value}) != len(value):
+            raise serializers.ValidationError('Every ticket may appear only once in the basket.')
+        return value
+
+
 class PaymentSerializer(serializers.Serializer):
     currency = serializers.CharField(max_length=3)
     amount = serializers.DecimalField(max_digits=10, decimal_places=2)
     reservations = serializers.ListField(child=serializers.IntegerField())
+    token = serializers.CharField(max_length=255, default='')
+
+
+class CheckoutSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Checkout
+        fields = ['id', 'status', 'message', 'amount', 'currency']
+
+
+class CheckoutQuerySerializer(serializers.Serializer):
+    wait = serializers.FloatField(min_value=0, max_value=settings.CHECKOUT_MAX_WAIT, default=0)
 
 
 class PurchasedTicketSerializer(serializers.ModelSerializer):
     class Meta:
         model = PurchasedTicket
         fields = ['owner', 'ticket', 'amount_of_tickets']
+
+
+class StatisticsQuerySerializer(serializers.Serializer):
+    event = serializers.IntegerField(required=False)
+
+
+class ReservedTicketsSeriesQuerySerializer(StatisticsQuerySerializer):
+    bucket = serializers.ChoiceField(choices=['minute', 'hour', 'day'], default='minute')
+
+
+class TicketTierImportSerializer(serializers.Serializer):
+    # one row of `manage.py import_tickets`, validated without touching the database
+    event = serializers.CharField(max_length=50)
+    datetime = serializers.DateTimeField()
+    type = serializers.ChoiceField(choices=TICKET_TYPES)
+    price = serializers.DecimalField(max_digits=6, decimal_places=2, min_value=0)
+    amount_of_tickets = serializers.IntegerField(min_value=0)
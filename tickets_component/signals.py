@@ -0,0 +1,50 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+
+from .models import Event, AvailableTicket, TicketReservation
+from . import caching, live, expiry
+
+# sent by the inventory with `event_ids` whenever queryset updates change the stock, which post_save doesn't see
+stock_changed = Signal()
+# sent with `owner_ids` whenever queryset writes change the reservations of these users
+reservations_changed = Signal()
+
+
+def _invalidate_on_commit(*scopes):
+    # invalidating before the commit would let a concurrent read cache the old rows again
+    transaction.on_commit(lambda: [caching.invalidate(scope) for scope in scopes])
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def invalidate_event(sender, instance, **kwargs):
+    _invalidate_on_commit(caching.CATALOGUE, caching.event_scope(instance.pk))
+
+
+@receiver(post_save, sender=AvailableTicket)
+@receiver(post_delete, sender=AvailableTicket)
+def invalidate_ticket(sender, instance, **kwargs):
+    _invalidate_on_commit(caching.TICKET_TERMS, caching.event_scope(instance.event_id))
+    transaction.on_commit(lambda: live.broadcaster.notify([instance.event_id]))
+
+
+@receiver(stock_changed)
+def invalidate_stock(sender, event_ids, **kwargs):
+    _invalidate_on_commit(*(caching.event_scope(event_id) for event_id in event_ids))
+    transaction.on_commit(lambda: live.broadcaster.notify(event_ids))
+
+
+@receiver(post_save, sender=TicketReservation)
+def invalidate_reservation(sender, instance, **kwargs):
+    _invalidate_on_commit(caching.owner_scope(instance.owner_id))
+
+
+@receiver(reservations_changed)
+def invalidate_reservations(sender, owner_ids, **kwargs):
+    _invalidate_on_commit(*(caching.owner_scope(owner_id) for owner_id in owner_ids))
+
+
+@receiver(post_save, sender=TicketReservation)
+def register_expiry(sender, instance, **kwargs):
+    expiry.register([instance.expiration_datetime])
@@ -1,18 +1,34 @@
 import datetime
+import time
 
-from django.db.models import F
+from celery import shared_task
+from django.conf import settings
 
-from .models import TicketReservation, AvailableTicket
+from .payments_adapter import payments as payments_adapter
+from . import inventory, checkout, idempotency
 
 
 def remove_obsolete_reservations():
-    print(f'run task: {remove_obsolete_reservations.__name__}, datetime: {datetime.datetime.now()}')
+    # expired reservations are reclaimed on demand by the request path too, so this task only compacts
+    # the ones nobody has asked about, minute by minute as their expiry buckets come due
     now = datetime.datetime.now()
-    obsolete_reservations = TicketReservation.objects.filter(expiration_datetime__lt=now)
-    for obs_res in obsolete_reservations:
-        ticket = AvailableTicket.objects.get(pk=obs_res.ticket.id)
-        print(obs_res, ticket)
-        ticket.amount_of_tickets = F('amount_of_tickets') + obs_res.amount_of_tickets
-        ticket.save()
-
-    obsolete_reservations.delete()
+    started = time.perf_counter()
+    removed = inventory.reclaim_due_buckets(now)
+    print(f'run task: {remove_obsolete_reservations.__name__}, datetime: {now}, '
+          f'removed reservations: {removed}, took: {time.perf_counter() - started:.3f}s')
+
+
+def remove_expired_idempotency_keys():
+    now = datetime.datetime.now()
+    removed = idempotency.remove_expired_keys(now)
+    print(f'run task: {remove_expired_idempotency_keys.__name__}, datetime: {now}, removed keys: {removed}')
+
+
+@shared_task(bind=True, max_retries=settings.CHECKOUT_CAPTURE_MAX_RETRIES)
+def capture_payment(self, checkout_id):
+    try:
+        checkout.capture(checkout_id)
+    except payments_adapter.PaymentError as ex:
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=2 ** self.request.retries)
+        checkout.fail(checkout_id, str(ex))
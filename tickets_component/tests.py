@@ -1,24 +1,66 @@
+import asyncio
 import datetime
+import io
+import json
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from unittest import mock
 
+from asgiref.sync import sync_to_async
 from rest_framework.test import APIClient
-from django.test import TransactionTestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import F, Sum
+from django.test import AsyncClient, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from kombu.exceptions import OperationalError
+from tickets_system import celery_app
 
 from .models import (
     AvailableTicket,
     Event,
     TicketReservation,
-    PurchasedTicket
+    PurchasedTicket,
+    PurchasedTicketStatistic,
+    IdempotencyKey,
+    Checkout,
+    InventoryLedgerCheckpoint,
+    InventoryLedgerTake,
+    ExpiryBucket,
+    TICKET_TYPES,
 )
-from .tasks import remove_obsolete_reservations
+from .serializers import TicketReservationSerializer
+from .tasks import remove_obsolete_reservations, capture_payment
+from .urls import urlpatterns
+from .ledger import Ledger
+from . import inventory, idempotency, admission, benchmarks, metrics, routers, live, expiry, checkout
+from .payments_adapter import payments as payments_adapter
 
 User = get_user_model()
 
 
 class TicketsComponentTestCase(TransactionTestCase):
     reset_sequences = True
+    # 'replica' is another connection to the test database
+    databases = {'default', 'replica'}
 
     def setUp(self):
+        cache.clear()
+        # payments are captured within the request instead of by a worker, only for the tests of this case
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
+        idempotency._responses.clear()
+        expiry._registered.clear()
+        metrics.reset()
         self.user = User.objects.create_user(username='abc', password='some_password')
         self.user_2 = User.objects.create_user(username='bcd', password='some_password')
         self.event_1 = Event.objects.create(name='festival', datetime=datetime.datetime.now())
@@ -41,12 +83,49 @@ class TicketsComponentTestCase(TransactionTestCase):
     def read_datetime_from_json(self, json):
         return datetime.datetime.strptime(json.get('datetime'), '%Y-%m-%dT%H:%M:%S.%f')
 
+    def test_sqlite_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
     def test_get_all_events(self):
         client = self.get_client()
         response = client.get('/api/events/')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data), 2)
 
+    def test_events_keyset_pagination(self):
+        start = datetime.datetime(2030, 1, 1)
+        for i in range(5):
+            Event.objects.create(name=f'concert {i}', datetime=start + datetime.timedelta(days=i // 2))
+        client = self.get_client()
+        names = []
+        url = '/api/events/?limit=2&since=2030-01-01T00:00:00'
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.json()), 2)
+            names.extend(el.get('name') for el in response.json())
+            url = response.get('Link', '')[1:].split('>')[0]
+        self.assertEqual(names, [f'concert {i}' for i in range(5)])
+
+        response = client.get('/api/events/?since=2030-01-01T00:00:00&until=2030-01-02T00:00:00')
+        self.assertEqual([el.get('name') for el in response.json()], ['concert 0', 'concert 1'])
+
+    def test_events_invalid_cursor(self):
+        response = self.get_client().get('/api/events/?cursor=abc')
+        self.assertEqual(response.status_code, 400)
+
+    def test_events_streaming(self):
+        client = self.get_client()
+        response = client.get('/api/events/?stream=true')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        events = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(events, client.get('/api/events/').json())
+
     def test_event_detail_view(self):
         client = self.get_client()
         response = client.get('/api/event/1/')
@@ -69,6 +148,29 @@ class TicketsComponentTestCase(TransactionTestCase):
         self.assertEqual(len(response.json()), 2)
         self.assertEqual({el.get('id') for el in response.json()}, {self.ticket_2.id, self.ticket_3.id})
 
+    def test_cached_event_reads_do_not_hit_database(self):
+        client = APIClient()
+        for url in ('/api/events/', '/api/event/1/', '/api/event/2/available_tickets'):
+            first = client.get(url)
+            with self.assertNumQueries(0):
+                second = client.get(url)
+            self.assertEqual(first.json(), second.json())
+
+    def test_cached_reads_invalidated_by_changes(self):
+        client = self.get_client()
+        client.get('/api/events/')
+        client.get('/api/event/1/')
+        client.get('/api/event/1/available_tickets')
+
+        self.event_1.name = 'renamed festival'
+        self.event_1.save()
+        Event.objects.create(name='festival 3', datetime=datetime.datetime.now())
+        client.post('/api/event/1/reserve_ticket', {'ticket': self.ticket_1.id, 'amount_of_tickets': 2})
+
+        self.assertEqual(len(client.get('/api/events/').json()), 3)
+        self.assertEqual(client.get('/api/event/1/').json().get('name'), 'renamed festival')
+        self.assertEqual(client.get('/api/event/1/available_tickets').json()[0].get('amount_of_tickets'), 1)
+
     def test_create_reservation(self):
         now_before_creating = datetime.datetime.now()
         initial_amount_of_available_tickets = self.ticket_1.amount_of_tickets
@@ -92,18 +194,279 @@ class TicketsComponentTestCase(TransactionTestCase):
         self.assertGreater(reservation.expiration_datetime, now_before_creating + datetime.timedelta(minutes=15))
         self.assertLess(reservation.expiration_datetime, now_before_creating + datetime.timedelta(minutes=16))
 
+    def test_reservation_writes_ticket_once(self):
+        client = self.get_client()
+        data = {'ticket': self.ticket_1.id, 'amount_of_tickets': 1}
+        self.assertEqual(client.post('/api/event/1/reserve_ticket', data).status_code, 201)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post('/api/event/1/reserve_ticket', data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json().get('event'), self.event_1.id)
+        ticket_queries = [q['sql'] for q in queries if 'tickets_component_availableticket' in q['sql']]
+        self.assertEqual(len(ticket_queries), 1, ticket_queries)
+        self.assertTrue(ticket_queries[0].startswith('UPDATE'))
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('INSERT')]), 1)
+
+        # the cached price follows the changes of the ticket
+        self.ticket_1.price = 7.0
+        self.ticket_1.save()
+        response = client.post('/api/event/1/reserve_ticket', data)
+        self.assertEqual(Decimal(response.json().get('amount_to_pay')), Decimal('7.00'))
+        response = client.post('/api/event/2/reserve_ticket', data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('message'), 'Ticket does not exist for this event.')
+
+    def test_fail_reservation_insufficient_tickets(self):
+        client = self.get_client()
+        response = client.post('/api/event/2/reserve_ticket', {
+            'ticket': self.ticket_3.id,
+            'amount_of_tickets': 2
+        })
+        self.ticket_3.refresh_from_db()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('message'), 'Insufficient number of tickets available.')
+        self.assertEqual(self.ticket_3.amount_of_tickets, 1)
+        self.assertFalse(TicketReservation.objects.exists())
+
+    def test_reserve_basket(self):
+        client = self.get_client()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post('/api/event/2/reserve_tickets', {'tickets': [
+                {'ticket': self.ticket_2.id, 'amount_of_tickets': 2},
+                {'ticket': self.ticket_3.id, 'amount_of_tickets': 1},
+            ]}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(Decimal(response.json().get('amount_to_pay')), Decimal('26.00'))
+        self.assertEqual({(r.get('ticket'), r.get('event')) for r in response.json().get('reservations')},
+                         {(self.ticket_2.id, 2), (self.ticket_3.id, 2)})
+        self.assertEqual({r.expiration_datetime for r in TicketReservation.objects.all()},
+                         {self.read_datetime_from_json({'datetime': response.json().get('expiration_datetime')})})
+        self.assertEqual(dict(AvailableTicket.objects.filter(event=2).values_list('id', 'amount_of_tickets')),
+                         {self.ticket_2.id: 1, self.ticket_3.id: 0})
+
+        response = client.post('/api/reservations/payment', {
+            'reservations': [r.get('id') for r in response.json().get('reservations')],
+            'currency': 'EUR', 'amount': 26.0
+        })
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(PurchasedTicket.objects.count(), 2)
+
+    def test_fail_reserve_basket_all_or_nothing(self):
+        client = self.get_client()
+        response = client.post('/api/event/2/reserve_tickets', {'tickets': [
+            {'ticket': self.ticket_2.id, 'amount_of_tickets': 2},
+            {'ticket': self.ticket_3.id, 'amount_of_tickets': 2},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('message'), 'Insufficient number of tickets available.')
+        self.assertFalse(TicketReservation.objects.exists())
+        self.assertEqual(dict(AvailableTicket.objects.filter(event=2).values_list('id', 'amount_of_tickets')),
+                         {self.ticket_2.id: 3, self.ticket_3.id: 1})
+
+        response = client.post('/api/event/2/reserve_tickets', {'tickets': [
+            {'ticket': self.ticket_1.id, 'amount_of_tickets': 1},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('message'), 'Ticket does not exist for this event.')
+        response = client.post('/api/event/2/reserve_tickets', {'tickets': [
+            {'ticket': self.ticket_2.id, 'amount_of_tickets': 1},
+            {'ticket': self.ticket_2.id, 'amount_of_tickets': 1},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_reservation_admission_queue(self):
+        client = self.get_client()
+        data = {'ticket': self.ticket_1.id, 'amount_of_tickets': 1}
+        with mock.patch.object(admission, 'queue', admission.AdmissionQueue(rate=2, burst=1, max_wait=1.2)):
+            self.assertEqual(client.post('/api/event/1/reserve_ticket', data).status_code, 201)
+            with self.assertNumQueries(0):
+                response = client.post('/api/event/1/reserve_ticket', data)
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.json().get('position'), 1)
+            self.assertEqual(response['Retry-After'], '1')
+            token = response.json().get('token')
+            self.assertEqual(client.get(f'/api/event/1/admission/{token}').json().get('position'), 1)
+            self.assertEqual(client.post('/api/event/1/reserve_ticket', data).json().get('position'), 2)
+            self.assertEqual(client.post('/api/event/1/reserve_ticket', data).status_code, 503)
+
+            time.sleep(0.5)
+            response = client.post('/api/event/1/reserve_ticket', data, HTTP_X_ADMISSION_TOKEN=token)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(client.get(f'/api/event/1/admission/{token}').status_code, 404)
+        self.assertEqual(TicketReservation.objects.count(), 2)
+
+    def test_reservation_retried_with_idempotency_key(self):
+        client = self.get_client()
+        data = {'ticket': self.ticket_1.id, 'amount_of_tickets': 1}
+        first = client.post('/api/event/1/reserve_ticket', data, HTTP_IDEMPOTENCY_KEY='abc')
+        idempotency._responses.clear()
+        second = client.post('/api/event/1/reserve_ticket', data, HTTP_IDEMPOTENCY_KEY='abc')
+        third = client.post('/api/event/1/reserve_ticket', data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.ticket_1.refresh_from_db()
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((second.status_code, second.json()), (201, first.json()))
+        self.assertEqual((third.status_code, third.json()), (201, first.json()))
+        self.assertEqual(third['Idempotent-Replayed'], 'true')
+        self.assertEqual(TicketReservation.objects.count(), 1)
+        self.assertEqual(self.ticket_1.amount_of_tickets, 2)
+
+        response = client.post('/api/event/1/reserve_ticket', data, HTTP_IDEMPOTENCY_KEY='bcd')
+        self.assertEqual(response.status_code, 201)
+        response = client.post('/api/reservations/payment', {'reservations': [1], 'currency': 'EUR', 'amount': 5.0},
+                               HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response.status_code, 422)
+
+    def test_idempotency_key_in_progress_and_expired(self):
+        client = self.get_client()
+        data = {'ticket': self.ticket_1.id, 'amount_of_tickets': 1}
+        key = IdempotencyKey.objects.create(owner=self.user, key='abc', path='/api/event/1/reserve_ticket')
+        response = client.post('/api/event/1/reserve_ticket', data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response.status_code, 409)
+
+        # the worker which claimed the key was killed, after the lease a retry claims it once again
+        IdempotencyKey.objects.filter(pk=key.pk).update(
+            created=datetime.datetime.now() - settings.IDEMPOTENCY_CLAIM_LEASE - datetime.timedelta(seconds=1)
+        )
+        response = client.post('/api/event/1/reserve_ticket', data, HTTP_IDEMPOTENCY_KEY='abc')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 201)
+        self.assertEqual(idempotency.remove_expired_keys(datetime.datetime.now() + datetime.timedelta(days=2)), 1)
+
+        # a response expired in memory gives way to the one stored after the key was claimed once again
+        IdempotencyKey.objects.create(owner=self.user, key='bcd', path='/api/event/1/reserve_ticket',
+                                      status_code=201, response={'id': 7})
+        idempotency._responses.set((self.user.id, 'bcd'), {
+            'path': '/api/event/1/reserve_ticket', 'status_code': 201, 'response': {'id': 3},
+            'created': datetime.datetime.now() - datetime.timedelta(days=2),
+        })
+        response = client.post('/api/event/1/reserve_ticket', data, HTTP_IDEMPOTENCY_KEY='bcd')
+        self.assertEqual((response.status_code, response.json()), (201, {'id': 7}))
+
     def test_get_user_reservations(self):
         client = self.get_client()
+        expiration_datetime = datetime.datetime.now() + datetime.timedelta(minutes=1)
         r1 = TicketReservation.objects.create(owner=self.user, ticket=self.ticket_1, amount_of_tickets=1,
-                                              amount_to_pay=5.0, expiration_datetime=datetime.datetime.now())
+                                              amount_to_pay=5.0, expiration_datetime=expiration_datetime)
         r2 = TicketReservation.objects.create(owner=self.user, ticket=self.ticket_2, amount_of_tickets=1,
-                                              amount_to_pay=10.0, expiration_datetime=datetime.datetime.now())
+                                              amount_to_pay=10.0, expiration_datetime=expiration_datetime)
         r3 = TicketReservation.objects.create(owner=self.user_2, ticket=self.ticket_1, amount_of_tickets=1,
-                                              amount_to_pay=5.0, expiration_datetime=datetime.datetime.now())
+                                              amount_to_pay=5.0, expiration_datetime=expiration_datetime)
+        TicketReservation.objects.create(owner=self.user, ticket=self.ticket_3, amount_of_tickets=1,
+                                         amount_to_pay=6.0, expiration_datetime=datetime.datetime.now())
         response = client.get('/api/reservations/')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.json()), 2)
         self.assertEqual({el.get('id') for el in response.json()}, {r1.id, r2.id})
+        reservations = TicketReservation.objects.filter(pk__in=[r1.id, r2.id]).order_by('id')
+        self.assertEqual(response.json(), json.loads(json.dumps(TicketReservationSerializer(reservations, many=True).data)))
+
+    def test_user_reservations_etag(self):
+        client = self.get_client()
+        TicketReservation.objects.create(owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+                                         expiration_datetime=datetime.datetime.now() + datetime.timedelta(seconds=0.5))
+        response = client.get('/api/reservations/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/reservations/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([q for q in queries.captured_queries if 'tickets_component' in q['sql']])
+
+        # a new reservation changes the list
+        client.post(f'/api/event/{self.event_2.id}/reserve_ticket', {'ticket': self.ticket_2.id, 'amount_of_tickets': 1})
+        response = client.get('/api/reservations/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, len(response.json())), (200, 2))
+        etag = response['ETag']
+        self.assertEqual(client.get('/api/reservations/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # and so does the expiry of the first one, without any write
+        time.sleep(0.5)
+        response = client.get('/api/reservations/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, len(response.json())), (200, 1))
+
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_read_your_writes(self):
+        client = self.get_client()
+        for owner in (self.user, self.user_2):
+            TicketReservation.objects.create(owner=owner, ticket=self.ticket_2, amount_of_tickets=1, amount_to_pay=10.0,
+                                             expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1))
+        routed = []
+        db_for_read = routers.ReplicaRouter.db_for_read
+
+        def record(router, model, **hints):
+            routed.append(db_for_read(router, model, **hints))
+            return routed[-1]
+
+        with mock.patch.object(routers.ReplicaRouter, 'db_for_read', record):
+            self.assertEqual(client.get('/api/reservations/').status_code, 200)
+            self.assertIn('replica', routed)
+            routed.clear()
+            response = client.post(f'/api/event/{self.event_1.id}/reserve_ticket',
+                                    {'ticket': self.ticket_1.id, 'amount_of_tickets': 1})
+            self.assertEqual(response.status_code, 201)
+            self.assertNotIn('replica', routed)
+            self.assertEqual(client.get('/api/reservations/').status_code, 200)
+            self.assertNotIn('replica', routed)
+            # other users keep reading from the replica
+            client.login(username=self.user_2, password='some_password')
+            self.assertEqual(client.get('/api/reservations/').status_code, 200)
+            self.assertIn('replica', routed)
+
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_available_tickets_from_replica(self):
+        client = self.get_client()
+        TicketReservation.objects.create(owner=self.user_2, ticket=self.ticket_1, amount_of_tickets=2,
+                                         amount_to_pay=10.0, expiration_datetime=datetime.datetime.now())
+        # the reclaim writes, so the stock it gives back is read from the primary too
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = client.get(f'/api/event/{self.event_1.id}/available_tickets')
+        self.assertEqual(response.json()[0]['amount_of_tickets'], 5)
+        self.assertFalse(replica.captured_queries)
+
+        cache.clear()
+        metrics.reset()
+        with CaptureQueriesContext(connections['default']) as primary:
+            with CaptureQueriesContext(connections['replica']) as replica:
+                response = client.get(f'/api/event/{self.event_1.id}/available_tickets')
+        self.assertEqual(response.json()[0]['amount_of_tickets'], 5)
+        self.assertTrue([q['sql'] for q in replica if 'tickets_component_availableticket' in q['sql']])
+        # only the look for expired reservations is left on the primary
+        self.assertEqual(len([q['sql'] for q in primary if 'tickets_component_' in q['sql']]), 1)
+        # the replica reads are measured too
+        self.assertEqual(metrics.snapshot()['endpoints']['GET api/event/<int:event_id>/available_tickets']
+                         ['queries']['mean'], len(primary) + len(replica))
+
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_cache_rebuilt_after_a_write_reads_primary(self):
+        client = self.get_client()
+        client_2 = APIClient()
+        client_2.login(username=self.user_2, password='some_password')
+        client_2.get(f'/api/event/{self.event_1.id}/available_tickets')
+        response = client.post(f'/api/event/{self.event_1.id}/reserve_ticket',
+                               {'ticket': self.ticket_1.id, 'amount_of_tickets': 1})
+        self.assertEqual(response.status_code, 201)
+        # another user rebuilds the entry the user who has reserved reads from the cache
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = client_2.get(f'/api/event/{self.event_1.id}/available_tickets')
+        self.assertEqual(response.json()[0]['amount_of_tickets'], 2)
+        self.assertFalse(replica.captured_queries)
+
+        cache.clear()
+        with CaptureQueriesContext(connections['replica']) as replica:
+            client_2.get(f'/api/event/{self.event_1.id}/available_tickets')
+        self.assertTrue(replica.captured_queries)
+
+    def test_available_tickets_without_expired_reservations_take_no_write_lock(self):
+        TicketReservation.objects.create(owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+                                         expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1))
+        client = self.get_client()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(f'/api/event/{self.event_1.id}/available_tickets')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q['sql'] for q in queries if q['sql'].startswith('BEGIN')])
 
     def test_remove_obsolete_reservation(self):
         amount_of_tickets_to_reserve = 2
@@ -118,6 +481,141 @@ class TicketsComponentTestCase(TransactionTestCase):
         self.assertEqual(available_tickets_amount_before_deleting,
                          self.ticket_1.amount_of_tickets - amount_of_tickets_to_reserve)
 
+    def test_sweep_visits_only_due_expiry_buckets(self):
+        now = datetime.datetime.now()
+        expired = TicketReservation.objects.create(owner=self.user, ticket=self.ticket_1, amount_of_tickets=1,
+                                                   amount_to_pay=5.0,
+                                                   expiration_datetime=now - datetime.timedelta(minutes=5))
+        held = TicketReservation.objects.create(owner=self.user, ticket=self.ticket_1, amount_of_tickets=1,
+                                                amount_to_pay=5.0,
+                                                expiration_datetime=now + datetime.timedelta(minutes=5))
+        self.assertEqual(ExpiryBucket.objects.count(), 2)
+        remove_obsolete_reservations()
+        self.assertFalse(TicketReservation.objects.filter(pk=expired.pk).exists())
+        self.assertTrue(TicketReservation.objects.filter(pk=held.pk).exists())
+        self.assertEqual(list(ExpiryBucket.objects.values_list('minute', flat=True)),
+                         [expiry.minute_of(held.expiration_datetime)])
+        # reservations outside of the buckets are left to the request path
+        TicketReservation.objects.filter(pk=held.pk).update(expiration_datetime=now - datetime.timedelta(hours=1))
+        remove_obsolete_reservations()
+        self.assertTrue(TicketReservation.objects.filter(pk=held.pk).exists())
+
+    def test_hold_duration_per_ticket(self):
+        client = self.get_client()
+        AvailableTicket.objects.filter(pk=self.ticket_2.pk).update(hold_minutes=5)
+        before = datetime.datetime.now()
+        response = client.post(f'/api/event/{self.event_2.id}/reserve_ticket',
+                               {'ticket': self.ticket_2.id, 'amount_of_tickets': 1})
+        self.assertEqual(response.status_code, 201)
+        reservation = TicketReservation.objects.get()
+        self.assertGreaterEqual(reservation.expiration_datetime, before + datetime.timedelta(minutes=5))
+        self.assertLess(reservation.expiration_datetime, before + datetime.timedelta(minutes=6))
+        self.assertTrue(ExpiryBucket.objects.filter(minute=expiry.minute_of(reservation.expiration_datetime)).exists())
+
+        response = client.post(f'/api/event/{self.event_2.id}/reserve_tickets', {'tickets': [
+            {'ticket': self.ticket_2.id, 'amount_of_tickets': 1},
+            {'ticket': self.ticket_3.id, 'amount_of_tickets': 1},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 201)
+        expiration_datetime = TicketReservation.objects.filter(ticket=self.ticket_3).get().expiration_datetime
+        self.assertLess(expiration_datetime, before + datetime.timedelta(minutes=6))
+        self.assertTrue(ExpiryBucket.objects.filter(minute=expiry.minute_of(expiration_datetime)).exists())
+
+    def test_expiry_bucket_of_rolled_back_transaction(self):
+        expiration_datetime = datetime.datetime.now() + datetime.timedelta(minutes=5)
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                expiry.register([expiration_datetime])
+                raise ValueError
+        self.assertFalse(ExpiryBucket.objects.exists())
+        # the minute isn't taken for registered, so the next hold in it creates its bucket
+        expiry.register([expiration_datetime])
+        self.assertTrue(ExpiryBucket.objects.filter(minute=expiry.minute_of(expiration_datetime)).exists())
+
+    def test_extend_reservation(self):
+        client = self.get_client()
+        AvailableTicket.objects.filter(pk=self.ticket_1.pk).update(hold_minutes=30)
+        reservation = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        for _ in range(settings.RESERVATION_MAX_EXTENSIONS):
+            response = client.post(f'/api/reservations/{reservation.id}/extend')
+            self.assertEqual(response.status_code, 200)
+        reservation.refresh_from_db()
+        self.assertEqual(reservation.extensions, settings.RESERVATION_MAX_EXTENSIONS)
+        self.assertGreater(reservation.expiration_datetime, datetime.datetime.now() + datetime.timedelta(minutes=29))
+        self.assertTrue(ExpiryBucket.objects.filter(minute=expiry.minute_of(reservation.expiration_datetime)).exists())
+        self.assertEqual(client.post(f'/api/reservations/{reservation.id}/extend').status_code, 400)
+
+        # expired reservations and reservations of others can't be extended
+        reservation = TicketReservation.objects.create(
+            owner=self.user_2, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        self.assertEqual(client.post(f'/api/reservations/{reservation.id}/extend').status_code, 400)
+        TicketReservation.objects.filter(pk=reservation.pk).update(
+            owner=self.user, expiration_datetime=datetime.datetime.now() - datetime.timedelta(seconds=1)
+        )
+        self.assertEqual(client.post(f'/api/reservations/{reservation.id}/extend').status_code, 400)
+
+    def test_user_reservations_constant_number_of_queries(self):
+        client = self.get_client()
+        expiration_datetime = datetime.datetime.now() + datetime.timedelta(minutes=1)
+        query_counts = []
+        for ticket in (self.ticket_1, self.ticket_2, self.ticket_3):
+            TicketReservation.objects.create(owner=self.user, ticket=ticket, amount_of_tickets=1,
+                                             amount_to_pay=ticket.price, expiration_datetime=expiration_datetime)
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get('/api/reservations/')
+            self.assertEqual(response.status_code, 200)
+            query_counts.append(len(queries))
+        self.assertEqual(len(response.json()), 3)
+        self.assertEqual({el.get('event') for el in response.json()}, {self.event_1.id, self.event_2.id})
+        self.assertEqual(len(set(query_counts)), 1, query_counts)
+
+    def test_reclaim_expired_reservations_in_batches(self):
+        expired = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        for ticket in (self.ticket_1, self.ticket_1, self.ticket_2, self.ticket_3):
+            TicketReservation.objects.create(owner=self.user, ticket=ticket, amount_of_tickets=1,
+                                             amount_to_pay=ticket.price, expiration_datetime=expired)
+        active = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_2, amount_of_tickets=2, amount_to_pay=20.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        reclaimed = inventory.reclaim_expired_reservations(datetime.datetime.now(), batch_size=3)
+        self.assertEqual(reclaimed, 4)
+        self.assertEqual(list(TicketReservation.objects.all()), [active])
+        self.assertEqual(
+            dict(AvailableTicket.objects.values_list('id', 'amount_of_tickets')),
+            {self.ticket_1.id: 5, self.ticket_2.id: 4, self.ticket_3.id: 2}
+        )
+
+    def test_available_tickets_include_expired_reservations(self):
+        TicketReservation.objects.create(owner=self.user, ticket=self.ticket_3, amount_of_tickets=1, amount_to_pay=6.0,
+                                         expiration_datetime=datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.ticket_3.amount_of_tickets = 0
+        self.ticket_3.save()
+        client = self.get_client()
+        response = client.get('/api/event/2/available_tickets')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({el.get('id'): el.get('amount_of_tickets') for el in response.json()},
+                         {self.ticket_2.id: 3, self.ticket_3.id: 1})
+        self.assertFalse(TicketReservation.objects.exists())
+
+    def test_reserve_tickets_held_by_expired_reservation(self):
+        TicketReservation.objects.create(owner=self.user_2, ticket=self.ticket_3, amount_of_tickets=1,
+                                         amount_to_pay=6.0,
+                                         expiration_datetime=datetime.datetime.now() - datetime.timedelta(seconds=1))
+        self.ticket_3.amount_of_tickets = 0
+        self.ticket_3.save()
+        client = self.get_client()
+        response = client.post('/api/event/2/reserve_ticket', {'ticket': self.ticket_3.id, 'amount_of_tickets': 1})
+        self.ticket_3.refresh_from_db()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.ticket_3.amount_of_tickets, 0)
+        self.assertEqual(list(TicketReservation.objects.values_list('owner', flat=True)), [self.user.id])
+
     def test_payment_one_reservation(self):
         client = self.get_client()
         r1 = TicketReservation.objects.create(
@@ -125,7 +623,7 @@ class TicketsComponentTestCase(TransactionTestCase):
             expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
         )
         response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0})
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 202)
         self.assertEqual(response.json().get('message'), "Payment succeeded.")
         self.assertTrue(r1 not in TicketReservation.objects.all())
         self.assertEqual(len(PurchasedTicket.objects.all()), 1)
@@ -146,7 +644,7 @@ class TicketsComponentTestCase(TransactionTestCase):
         )
         response = client.post('/api/reservations/payment',
                                {'reservations': [r1.id, r2.id], 'currency': 'EUR', 'amount': 25.0})
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 202)
         self.assertEqual(response.json().get('message'), "Payment succeeded.")
         self.assertTrue(r1 not in TicketReservation.objects.all())
         self.assertTrue(r2 not in TicketReservation.objects.all())
@@ -154,6 +652,257 @@ class TicketsComponentTestCase(TransactionTestCase):
         purchased_tickets = PurchasedTicket.objects.all()
         self.assertEqual({t.ticket.id for t in purchased_tickets}, {self.ticket_1.id, self.ticket_2.id})
 
+    def test_payment_constant_number_of_queries(self):
+        client = self.get_client()
+        expiration_datetime = datetime.datetime.now() + datetime.timedelta(minutes=1)
+        query_counts = []
+        # the first purchase also creates the statistics row
+        for amount in (1, 1, 3):
+            reservations = [
+                TicketReservation.objects.create(owner=self.user, ticket=self.ticket_2, amount_of_tickets=1,
+                                                 amount_to_pay=10.0, expiration_datetime=expiration_datetime)
+                for _ in range(amount)
+            ]
+            with CaptureQueriesContext(connection) as queries:
+                response = client.post('/api/reservations/payment', {
+                    'reservations': [r.id for r in reservations], 'currency': 'EUR', 'amount': 10.0 * amount
+                })
+            self.assertEqual(response.status_code, 202)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[1], query_counts[2])
+        self.assertEqual(PurchasedTicket.objects.count(), 5)
+
+    @override_settings(METRICS_SLOW_REQUEST_THRESHOLD=0)
+    def test_metrics(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0})
+        self.assertEqual(response.status_code, 202)
+        query_count = len(queries)
+        self.assertEqual(client.get('/api/metrics/').status_code, 403)
+
+        User.objects.filter(pk=self.user.pk).update(is_staff=True)
+        response = client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        payment = response.data['endpoints']['POST api/reservations/payment']
+        self.assertEqual({'queries', 'db', 'gateway', 'render', 'total'}, payment.keys())
+        self.assertEqual(payment['total']['count'], 1)
+        self.assertEqual(payment['queries']['mean'], query_count)
+        slow_request = response.data['slow_requests'][0]
+        self.assertEqual(slow_request['path'], '/api/reservations/payment')
+        self.assertEqual(len(slow_request['queries']), query_count)
+
+    def test_fail_payment_reservation_of_another_user(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user_2, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('message'), 'Reservation does not exist or expired.')
+        self.assertFalse(PurchasedTicket.objects.exists())
+
+    def test_fail_payment_card_declined(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        response = client.post('/api/reservations/payment',
+                               {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0, 'token': 'card_error'})
+        self.assertEqual(response.status_code, 202)
+        response = client.get(f'/api/reservations/payment/{response.json().get("id")}')
+        self.assertEqual(response.json().get('status'), 'failed')
+        self.assertEqual(response.json().get('message'), 'Your card has been declined')
+        r1.refresh_from_db()
+        self.assertIsNone(r1.checkout)
+        self.assertFalse(PurchasedTicket.objects.exists())
+
+    def test_long_poll_does_not_hold_other_requests(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        with mock.patch.object(capture_payment, 'delay'):
+            response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR',
+                                                                 'amount': 5.0})
+        checkout_id = response.json().get('id')
+
+        async def requests():
+            async_client = AsyncClient()
+            async_client.cookies = client.cookies
+            poll = asyncio.ensure_future(async_client.get(f'/api/reservations/payment/{checkout_id}?wait=2'))
+            await asyncio.sleep(0.2)
+            started = time.monotonic()
+            response = await async_client.get('/api/events/')
+            elapsed = time.monotonic() - started
+            return response, elapsed, await poll
+
+        # the long-poll waits on the event loop of the ASGI handler while the other request is served
+        response, elapsed, poll = asyncio.run(requests())
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(elapsed, 1)
+        self.assertEqual(json.loads(poll.content).get('status'), 'pending')
+        # and the queries of the sync views run in the worker thread are still measured
+        self.assertGreater(metrics.snapshot()['endpoints']['GET api/events/']['queries']['mean'], 0)
+
+    def test_checkout_status(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        with mock.patch.object(capture_payment, 'delay'):
+            response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR',
+                                                                 'amount': 5.0})
+        self.assertEqual(response.status_code, 202)
+        checkout_id = response.json().get('id')
+        self.assertEqual(response['Location'], f'http://testserver/api/reservations/payment/{checkout_id}')
+        response = client.get(f'/api/reservations/payment/{checkout_id}?wait=0.1')
+        self.assertEqual(response.json().get('status'), 'pending')
+        # a held reservation can't be paid twice
+        response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0})
+        self.assertEqual(response.status_code, 400)
+
+        capture_payment.delay(checkout_id)
+        response = client.get(f'/api/reservations/payment/{checkout_id}')
+        self.assertEqual(response.json().get('status'), 'succeeded')
+        self.assertEqual(PurchasedTicket.objects.get().ticket, self.ticket_1)
+        response = APIClient().get(f'/api/reservations/payment/{checkout_id}')
+        self.assertEqual(response.status_code, 403)
+
+    def test_capture_charges_outside_of_transaction(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        charged = []
+
+        def charge(amount, token, currency, reference):
+            charged.append((connection.in_atomic_block, Checkout.objects.get().status, reference))
+            return payments_adapter.PaymentResult(amount, currency)
+        with mock.patch.object(payments_adapter.PaymentGateway, 'charge', side_effect=charge):
+            response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR',
+                                                                 'amount': 5.0})
+        checkout_id = response.json().get('id')
+        self.assertEqual(charged, [(False, 'capturing', f'checkout-{checkout_id}')])
+        self.assertEqual(response.json().get('status'), 'succeeded')
+        self.assertEqual(PurchasedTicket.objects.get().ticket, self.ticket_1)
+
+    def test_payment_not_queued(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        with mock.patch.object(capture_payment, 'delay', side_effect=OperationalError('Broker unavailable')):
+            response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR',
+                                                                 'amount': 5.0})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(Checkout.objects.get().status, 'failed')
+        r1.refresh_from_db()
+        self.assertIsNone(r1.checkout)
+        response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0})
+        self.assertEqual(response.json().get('status'), 'succeeded')
+
+    def test_capture_retries_payment_errors(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        with mock.patch.object(payments_adapter.PaymentGateway, 'charge',
+                               side_effect=payments_adapter.PaymentError('Gateway unavailable')) as charge:
+            response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR',
+                                                                 'amount': 5.0})
+        self.assertEqual(charge.call_count, settings.CHECKOUT_CAPTURE_MAX_RETRIES + 1)
+        self.assertEqual(response.json().get('status'), 'failed')
+        self.assertEqual(response.json().get('message'), 'Gateway unavailable')
+
+    def test_async_payment(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(seconds=1)
+        )
+        response = client.post('/api/reservations/payment/async',
+                               {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json().get('message'), 'Payment succeeded.')
+        self.assertFalse(TicketReservation.objects.exists())
+        self.assertEqual(PurchasedTicket.objects.get().ticket, self.ticket_1)
+
+    def test_async_payment_timeout(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        references = []
+
+        def charge(amount, token, currency='EUR', reference=None):
+            references.append(reference)
+            if len(references) == 1:
+                time.sleep(0.2)
+            return payments_adapter.PaymentResult(amount, currency)
+
+        gateway = payments_adapter.AsyncPaymentGateway(timeout=0.05)
+        with mock.patch.object(checkout, 'async_payment_gateway', return_value=gateway), \
+                mock.patch.object(payments_adapter.PaymentGateway, 'charge', side_effect=charge):
+            response = client.post('/api/reservations/payment/async',
+                                   {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0}, format='json')
+            time.sleep(0.2)
+        # the timed out charge may be taken, so the capture charges the checkout with the same reference
+        self.assertEqual(response.status_code, 202)
+        checkout_id = response.json().get('id')
+        self.assertEqual(references, [f'checkout-{checkout_id}'] * 2)
+        self.assertEqual(Checkout.objects.get().status, 'succeeded')
+        self.assertEqual(PurchasedTicket.objects.get().ticket, self.ticket_1)
+
+    def test_payment_claims_reservations(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        ch = checkout.hold_reservations(self.user, [r1.id], Decimal('5.00'), 'EUR', '')
+        # while the first payment is charged neither another one nor the sync endpoint can claim the reservation
+        with self.assertRaises(checkout.CheckoutError):
+            checkout.hold_reservations(self.user, [r1.id], Decimal('5.00'), 'EUR', '')
+        response = client.post('/api/reservations/payment', {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0})
+        self.assertEqual(response.status_code, 400)
+        checkout.finish_checkout(ch.id)
+        with self.assertRaises(checkout.CheckoutError):
+            checkout.finish_checkout(ch.id)
+        self.assertEqual(PurchasedTicket.objects.count(), 1)
+
+    def test_fail_async_payment(self):
+        client = self.get_client()
+        r1 = TicketReservation.objects.create(
+            owner=self.user, ticket=self.ticket_1, amount_of_tickets=1, amount_to_pay=5.0,
+            expiration_datetime=datetime.datetime.now() + datetime.timedelta(minutes=1)
+        )
+        response = client.post('/api/reservations/payment/async',
+                               {'reservations': [r1.id], 'currency': 'EUR', 'amount': 4.0}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('message'), 'Wrong amount of money for this payment request.')
+        response = client.post('/api/reservations/payment/async',
+                               {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0, 'token': 'payment_error'},
+                               format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('message'), 'Something went wrong with your transaction')
+        response = APIClient().post('/api/reservations/payment/async',
+                                    {'reservations': [r1.id], 'currency': 'EUR', 'amount': 5.0}, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(PurchasedTicket.objects.exists())
+
     def test_fail_payment_wrong_amount_of_money(self):
         client = self.get_client()
         r1 = TicketReservation.objects.create(
@@ -170,9 +919,9 @@ class TicketsComponentTestCase(TransactionTestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json().get('message'), 'Reservation does not exist or expired.')
 
-    def test_statistics_reserved_tickets_all_types(self):
+    def test_statistics_available_tickets_all_types(self):
         client = self.get_client()
-        response = client.get('/api/statistics/reserved_tickets/')
+        response = client.get('/api/statistics/available_tickets/')
         self.assertEqual(response.status_code, 200)
         self.assertEqual({tuple((k, v) for k, v in r.items()) for r in response.json()}, {tuple(r) for r in [
             (('event_id', 1), ('type', 'regular'), ('quantity', 3)),
@@ -180,10 +929,593 @@ class TicketsComponentTestCase(TransactionTestCase):
             (('event_id', 2), ('type', 'VIP'), ('quantity', 3)),
         ]})
 
-    def test_statistics_reserved_tickets_for_certain_type(self):
+    def test_statistics_available_tickets_for_certain_type(self):
         client = self.get_client()
-        response = client.get('/api/statistics/reserved_tickets/regular/')
+        response = client.get('/api/statistics/available_tickets/regular/')
         self.assertEqual(response.status_code, 200)
         self.assertEqual({tuple((k, v) for k, v in r.items()) for r in response.json()}, {tuple(r) for r in [
             (('event_id', 1), ('type', 'regular'), ('quantity', 3)),
         ]})
+
+    def create_reservations_for_statistics(self):
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        for ticket, amount, expiration_datetime in (
+            (self.ticket_1, 2, now + datetime.timedelta(minutes=3, seconds=10)),
+            (self.ticket_2, 1, now + datetime.timedelta(minutes=3, seconds=20)),
+            (self.ticket_2, 2, now + datetime.timedelta(minutes=5)),
+            (self.ticket_3, 1, now - datetime.timedelta(minutes=1)),
+        ):
+            TicketReservation.objects.create(owner=self.user, ticket=ticket, amount_of_tickets=amount,
+                                             amount_to_pay=ticket.price * amount,
+                                             expiration_datetime=expiration_datetime)
+        return now
+
+    def test_statistics_reserved_tickets(self):
+        self.create_reservations_for_statistics()
+        client = self.get_client()
+        response = client.get('/api/statistics/reserved_tickets/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({tuple((k, v) for k, v in r.items()) for r in response.json()}, {tuple(r) for r in [
+            (('event_id', 1), ('type', 'regular'), ('quantity', 2)),
+            (('event_id', 2), ('type', 'VIP'), ('quantity', 3)),
+        ]})
+        response = client.get('/api/statistics/reserved_tickets/VIP/?event=2')
+        self.assertEqual([r.get('quantity') for r in response.json()], [3])
+        response = client.get('/api/statistics/reserved_tickets/?event=1')
+        self.assertEqual([r.get('event_id') for r in response.json()], [1])
+
+    def test_statistics_reserved_tickets_series(self):
+        now = self.create_reservations_for_statistics()
+        client = self.get_client()
+        response = client.get('/api/statistics/reserved_tickets/series/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(r.get('expiration'), r.get('quantity')) for r in response.json()], [
+            ((now + datetime.timedelta(minutes=3)).isoformat(), 3),
+            ((now + datetime.timedelta(minutes=5)).isoformat(), 2),
+        ])
+        response = client.get('/api/statistics/reserved_tickets/series/?bucket=week')
+        self.assertEqual(response.status_code, 400)
+
+    def test_statistics_purchased_tickets(self):
+        client = self.get_client()
+        expiration_datetime = datetime.datetime.now() + datetime.timedelta(minutes=1)
+        r1 = TicketReservation.objects.create(owner=self.user, ticket=self.ticket_2, amount_of_tickets=2,
+                                              amount_to_pay=20.0, expiration_datetime=expiration_datetime)
+        r2 = TicketReservation.objects.create(owner=self.user, ticket=self.ticket_3, amount_of_tickets=1,
+                                              amount_to_pay=6.0, expiration_datetime=expiration_datetime)
+        client.post('/api/reservations/payment', {'reservations': [r1.id, r2.id], 'currency': 'EUR', 'amount': 26.0})
+        r3 = TicketReservation.objects.create(owner=self.user, ticket=self.ticket_2, amount_of_tickets=1,
+                                              amount_to_pay=10.0, expiration_datetime=expiration_datetime)
+        client.post('/api/reservations/payment', {'reservations': [r3.id], 'currency': 'EUR', 'amount': 10.0})
+
+        response = client.get('/api/statistics/purchased_tickets/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({tuple((k, v) for k, v in r.items()) for r in response.json()}, {tuple(r) for r in [
+            (('event_id', 2), ('type', 'VIP'), ('quantity', 3)),
+            (('event_id', 2), ('type', 'premium'), ('quantity', 1)),
+        ]})
+        response = client.get('/api/statistics/purchased_tickets/VIP/')
+        self.assertEqual([r.get('quantity') for r in response.json()], [3])
+
+    def test_rebuild_and_check_purchased_statistics(self):
+        PurchasedTicket.objects.create(owner=self.user, ticket=self.ticket_1, amount_of_tickets=2)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_ticket_statistics', '--check', stdout=io.StringIO())
+        call_command('rebuild_ticket_statistics', stdout=io.StringIO())
+        call_command('rebuild_ticket_statistics', '--check', stdout=io.StringIO())
+        self.assertEqual(
+            list(PurchasedTicketStatistic.objects.values_list('event_id', 'type', 'amount_of_tickets')),
+            [(self.event_1.id, 'r', 2)]
+        )
+
+    def test_import_tickets(self):
+        client = self.get_client()
+        self.assertEqual(len(client.get('/api/events/').json()), 2)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as f:
+            f.write('event,datetime,type,price,amount_of_tickets\n'
+                    f'festival,{self.event_1.datetime.isoformat()},r,7.50,10\n'
+                    f'festival,{self.event_1.datetime.isoformat()},V,20.00,2\n'
+                    'opera,2030-01-01T20:00:00,r,30.00,100\n'
+                    'opera,2030-01-01T20:00:00,p,50.00,20\n')
+            f.flush()
+            out = io.StringIO()
+            call_command('import_tickets', f.name, '--batch-size', '3', stdout=out)
+            self.assertIn('Created 1 events and 3 ticket tiers, updated 1 ticket tiers.', out.getvalue())
+            # the stock of an existing tier may have been held or sold since, so it's kept
+            self.ticket_1.refresh_from_db()
+            self.assertEqual((self.ticket_1.price, self.ticket_1.amount_of_tickets), (Decimal('7.50'), 3))
+            opera = Event.objects.get(name='opera')
+            self.assertEqual(dict(opera.availableticket_set.values_list('type', 'amount_of_tickets')),
+                             {'r': 100, 'p': 20})
+            # the cached catalogue has been invalidated
+            self.assertEqual(len(client.get('/api/events/').json()), 3)
+
+            self.assertEqual(client.get('/api/event/1/available_tickets').json()[0]['amount_of_tickets'], 3)
+            call_command('import_tickets', f.name, '--replace-stock', stdout=io.StringIO())
+        self.ticket_1.refresh_from_db()
+        self.assertEqual(self.ticket_1.amount_of_tickets, 10)
+        self.assertEqual(client.get('/api/event/1/available_tickets').json()[0]['amount_of_tickets'], 10)
+
+    def test_import_tickets_invalid_row(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write(json.dumps({'event': 'opera', 'datetime': '2030-01-01T20:00:00', 'type': 'r', 'price': '30',
+                                'amount_of_tickets': 100}) + '\n')
+            f.write(json.dumps({'event': 'opera', 'datetime': '2030-01-01T20:00:00', 'type': 'x', 'price': '30',
+                                'amount_of_tickets': -1}) + '\n')
+            f.flush()
+            with self.assertRaisesMessage(CommandError, 'line 2'):
+                call_command('import_tickets', f.name, '--dry-run', stdout=io.StringIO())
+        self.assertFalse(Event.objects.filter(name='opera').exists())
+
+    def test_export_tickets(self):
+        PurchasedTicket.objects.create(owner=self.user, ticket=self.ticket_2, amount_of_tickets=2)
+        out = io.StringIO()
+        call_command('export_tickets', 'stock', '--format', 'jsonl', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(r['id'], r['event__name'], r['price'], r['amount_of_tickets']) for r in rows], [
+            (self.ticket_1.id, 'festival', '5.00', 3),
+            (self.ticket_2.id, 'festival 2', '10.00', 3),
+            (self.ticket_3.id, 'festival 2', '6.00', 1),
+        ])
+        out = io.StringIO()
+        call_command('export_tickets', 'purchases', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            'id,owner_id,ticket_id,ticket__event_id,ticket__type,amount_of_tickets',
+            f'1,{self.user.id},{self.ticket_2.id},{self.event_2.id},V,2',
+        ])
+
+
+class InventoryStressTestCase(TransactionTestCase):
+    workers = 8
+    attempts_per_worker = 50
+
+    def setUp(self):
+        event = Event.objects.create(name='flash sale', datetime=datetime.datetime.now())
+        self.ticket = AvailableTicket.objects.create(event=event, amount_of_tickets=100, price=5.0, type='r')
+
+    def reserve_in_thread(self):
+        succeeded = 0
+        try:
+            for _ in range(self.attempts_per_worker):
+                if inventory.reserve_tickets(self.ticket, 1):
+                    succeeded += 1
+        finally:
+            connection.close()
+        return succeeded
+
+    def test_concurrent_reservations_do_not_oversell(self):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(lambda _: self.reserve_in_thread(), range(self.workers)))
+        elapsed = time.perf_counter() - started
+        self.ticket.refresh_from_db()
+        self.assertEqual(sum(results), 100)
+        self.assertEqual(self.ticket.amount_of_tickets, 0)
+        print(f'\n{self.workers * self.attempts_per_worker} reservation attempts, '
+              f'{self.workers * self.attempts_per_worker / elapsed:.0f} reservations/s', file=sys.stderr)
+
+
+class QueryPlanTestCase(TransactionTestCase):
+    # big enough for the planner statistics to prefer a full scan wherever no index fits
+    users = 100
+    events = 200
+    reservations = 10000
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        User.objects.bulk_create([User(username=f'user {i}') for i in range(self.users)])
+        users = list(User.objects.all())
+        Event.objects.bulk_create([Event(name=f'event {i}', datetime=now) for i in range(self.events)])
+        AvailableTicket.objects.bulk_create([
+            AvailableTicket(event=event, amount_of_tickets=100, price=5.0, type=type_)
+            for event in Event.objects.all() for type_, _ in TICKET_TYPES
+        ])
+        tickets = list(AvailableTicket.objects.all())
+        TicketReservation.objects.bulk_create([
+            TicketReservation(owner=users[i % len(users)], ticket=tickets[i % len(tickets)], amount_of_tickets=1,
+                              amount_to_pay=5.0,
+                              expiration_datetime=now + datetime.timedelta(seconds=i - self.reservations // 2))
+            for i in range(self.reservations)
+        ], batch_size=1000)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.user = users[0]
+        self.now = now
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        if connection.vendor == 'sqlite':
+            # a SCAN reads every row even when it's USING an index, only a SEARCH narrows down a range of it
+            self.assertRegex(plan, r'SEARCH \S+ USING ', plan)
+            self.assertNotRegex(plan, r'\bSCAN\b', plan)
+        else:
+            self.assertIn('Index', plan, plan)
+            self.assertNotIn('Seq Scan', plan, plan)
+
+    def test_reclaim_uses_index(self):
+        self.assertUsesIndex(
+            TicketReservation.objects.filter(expiration_datetime__lt=self.now)
+            .order_by('expiration_datetime', 'pk').values_list('pk', 'ticket_id', 'amount_of_tickets')[:1000]
+        )
+        self.assertUsesIndex(TicketReservation.objects.filter(expiration_datetime__lt=self.now, ticket=1))
+        # the look for expired reservations before a reclaim, which has no other condition
+        self.assertUsesIndex(TicketReservation.objects.filter(expiration_datetime__lt=self.now).values('pk')[:1])
+
+    def test_user_reservations_use_index(self):
+        self.assertUsesIndex(TicketReservation.objects.filter(owner=self.user))
+        self.assertUsesIndex(TicketReservation.objects.filter(owner=self.user, expiration_datetime__gte=self.now))
+
+    def test_reserved_tickets_statistics_use_index(self):
+        reservations = TicketReservation.objects.filter(expiration_datetime__gte=self.now)
+        # the sum per ticket reads the covering ticket index in its order, neither the reservations nor a sort
+        plan = reservations.values_list('ticket_id').annotate(quantity=Sum('amount_of_tickets')).explain()
+        if connection.vendor == 'sqlite':
+            self.assertIn('COVERING INDEX tickets_com_ticket__6e5a9a_idx', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+        self.assertUsesIndex(AvailableTicket.objects.filter(pk__in=[1, 2, 3]).values_list('id', 'event_id', 'type'))
+        self.assertUsesIndex(
+            reservations.filter(ticket__in=AvailableTicket.objects.filter(event_id=1))
+            .values_list('ticket_id').annotate(quantity=Sum('amount_of_tickets'))
+        )
+
+    def test_payment_uses_index(self):
+        self.assertUsesIndex(TicketReservation.objects.filter(pk__in=[1, 2, 3], expiration_datetime__gte=self.now))
+
+    def test_event_tickets_use_index(self):
+        self.assertUsesIndex(AvailableTicket.objects.filter(event=1))
+        self.assertUsesIndex(
+            AvailableTicket.objects.filter(type='r').values('event_id', 'type').annotate(quantity=Sum('amount_of_tickets'))
+        )
+
+
+class LedgerTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.journal = tempfile.NamedTemporaryFile(suffix='.journal')
+        self.addCleanup(self.journal.close)
+        self.user = User.objects.create_user(username='abc', password='some_password')
+        self.event = Event.objects.create(name='festival', datetime=datetime.datetime.now())
+        self.ticket = AvailableTicket.objects.create(event=self.event, amount_of_tickets=10, price=5.0, type='r')
+
+    def get_ledger(self):
+        ledger = Ledger(self.journal.name, fsync=False)
+        ledger.recover()
+        return ledger
+
+    def amount_in_db(self):
+        self.ticket.refresh_from_db()
+        return self.ticket.amount_of_tickets
+
+    def test_write_behind(self):
+        ledger = self.get_ledger()
+        self.assertTrue(ledger.reserve({self.ticket.id: 2}))
+        self.assertFalse(ledger.reserve({self.ticket.id: 9}))
+        ledger.release({self.ticket.id: 1})
+        self.assertEqual(ledger.available([self.ticket.id]), {self.ticket.id: 9})
+        self.assertEqual(self.amount_in_db(), 10)
+        self.assertEqual(ledger.flush(), 2)
+        self.assertEqual(self.amount_in_db(), 9)
+        self.assertEqual(InventoryLedgerCheckpoint.objects.get().sequence, 2)
+
+    def test_flush_notifies_live_streams(self):
+        ledger = self.get_ledger()
+        self.assertTrue(ledger.reserve({self.ticket.id: 2}))
+        with mock.patch.object(live.broadcaster, 'notify') as notify:
+            ledger.flush()
+        notify.assert_called_once_with({self.event.id})
+
+    def test_failed_flush_is_retried(self):
+        ledger = self.get_ledger()
+        self.assertTrue(ledger.reserve({self.ticket.id: 2}))
+        stop = threading.Event()
+        flush = ledger.flush
+        calls = []
+
+        def flush_once_locked():
+            calls.append(None)
+            if len(calls) == 1:
+                raise DatabaseError('database is locked')
+            stop.set()
+            return flush()
+        with mock.patch.object(ledger, 'flush', flush_once_locked), self.assertLogs('tickets_component.ledger'):
+            ledger.run(0.01, stop)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.amount_in_db(), 8)
+
+    def test_reserve_during_flush(self):
+        ledger = self.get_ledger()
+        self.assertTrue(ledger.reserve({self.ticket.id: 2}))
+        apply = ledger._apply
+
+        def apply_while_reserving(entries, sequence):
+            apply(entries, sequence)
+            self.assertTrue(ledger.reserve({self.ticket.id: 3}))
+        with mock.patch.object(ledger, '_apply', apply_while_reserving):
+            self.assertEqual(ledger.flush(), 1)
+        self.assertEqual(self.amount_in_db(), 8)
+        self.assertEqual(ledger.available([self.ticket.id]), {self.ticket.id: 5})
+        self.assertEqual(ledger.flush(), 1)
+        self.assertEqual(self.amount_in_db(), 5)
+        self.assertEqual(ledger.available([self.ticket.id]), {self.ticket.id: 5})
+
+    def test_recovery(self):
+        self.assertTrue(self.get_ledger().reserve({self.ticket.id: 3}))
+        # the process dies before the flush, the next one replays the journal once
+        ledger = Ledger(self.journal.name, fsync=False)
+        self.assertEqual(ledger.recover(), 1)
+        self.assertEqual(self.amount_in_db(), 7)
+        self.assertEqual(Ledger(self.journal.name, fsync=False).recover(), 0)
+        self.assertEqual(self.amount_in_db(), 7)
+        # entries the checkpoint already covers are skipped
+        with open(self.journal.name, 'w') as f:
+            f.write(json.dumps([1, self.ticket.id, -3]) + '\n')
+        self.assertEqual(Ledger(self.journal.name, fsync=False).recover(), 0)
+        self.assertEqual(self.amount_in_db(), 7)
+
+    def test_checkpoint_covers_entries(self):
+        ledger = self.get_ledger()
+        ledger._apply([(1, self.ticket.id, -1), (2, self.ticket.id, -2)], 2)
+        # a journal replaced under the ledger hands over entries the checkpoint already covers
+        ledger._apply([(1, self.ticket.id, -1), (2, self.ticket.id, -2), (3, self.ticket.id, -4)], 3)
+        self.assertEqual(self.amount_in_db(), 3)
+
+    def test_open_takes(self):
+        ledger = self.get_ledger()
+        take = ledger.reserve({self.ticket.id: 2}, confirmed=True)
+        self.assertTrue(ledger.reserve({self.ticket.id: 1}))
+        # the reservation of the take hasn't committed yet
+        self.assertEqual(ledger.flush(), 0)
+        self.assertEqual(self.amount_in_db(), 10)
+        ledger.settle(take)
+        self.assertEqual(ledger.flush(), 2)
+        self.assertEqual(self.amount_in_db(), 7)
+
+    def test_recovery_of_unconfirmed_takes(self):
+        ledger = self.get_ledger()
+        take = ledger.reserve({self.ticket.id: 2}, confirmed=True)
+        InventoryLedgerTake.objects.create(sequence=take)
+        ledger.settle(take)
+        # the process dies after the take, before its reservation commits
+        ledger.reserve({self.ticket.id: 3}, confirmed=True)
+        self.assertEqual(Ledger(self.journal.name, fsync=False).recover(), 1)
+        self.assertEqual(self.amount_in_db(), 8)
+        self.assertFalse(InventoryLedgerTake.objects.exists())
+
+    def test_sweep_does_not_start_ledger(self):
+        TicketReservation.objects.create(owner=self.user, ticket=self.ticket, amount_of_tickets=2, amount_to_pay=10.0,
+                                         expiration_datetime=datetime.datetime.now())
+        with override_settings(INVENTORY_LEDGER_EVENTS=[self.event.id], INVENTORY_LEDGER_JOURNAL=self.journal.name):
+            inventory.ledger.cache_clear()
+            self.addCleanup(inventory.ledger.cache_clear)
+            self.assertEqual(inventory.reclaim_expired_reservations(datetime.datetime.now()), 1)
+            self.assertEqual(inventory.ledger.cache_info().currsize, 0)
+        self.assertEqual(self.amount_in_db(), 12)
+
+    def test_reconciliation(self):
+        ledger = self.get_ledger()
+        self.assertTrue(ledger.reserve({self.ticket.id: 4}))
+        AvailableTicket.objects.filter(pk=self.ticket.pk).update(amount_of_tickets=F('amount_of_tickets') + 5)
+        ledger.flush()
+        self.assertEqual(ledger.available([self.ticket.id]), {self.ticket.id: 11})
+
+    def test_reserve_through_ledger(self):
+        with override_settings(INVENTORY_LEDGER_EVENTS=[self.event.id], INVENTORY_LEDGER_JOURNAL=self.journal.name,
+                               INVENTORY_LEDGER_FSYNC=False, INVENTORY_LEDGER_FLUSH_INTERVAL=3600):
+            inventory.ledger.cache_clear()
+            self.addCleanup(inventory.ledger.cache_clear)
+            client = APIClient()
+            client.login(username=self.user, password='some_password')
+            response = client.post(f'/api/event/{self.event.id}/reserve_ticket',
+                                   {'ticket': self.ticket.id, 'amount_of_tickets': 3})
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(self.amount_in_db(), 10)
+            response = client.get(f'/api/event/{self.event.id}/available_tickets')
+            self.assertEqual(response.json()[0]['amount_of_tickets'], 7)
+
+            # a rolled back reservation gives its tickets back to the ledger
+            with self.assertRaises(RuntimeError):
+                with inventory.reserving():
+                    self.assertTrue(inventory.reserve_tickets(self.ticket, 2))
+                    raise RuntimeError()
+            self.assertEqual(inventory.ledger().available([self.ticket.id]), {self.ticket.id: 7})
+
+            # expired reservations are released to the ledger too
+            TicketReservation.objects.update(expiration_datetime=datetime.datetime.now())
+            inventory.reclaim_expired_reservations(datetime.datetime.now())
+            self.assertEqual(inventory.ledger().available([self.ticket.id]), {self.ticket.id: 10})
+            inventory.ledger().flush()
+            self.assertEqual(self.amount_in_db(), 10)
+
+
+class LiveAvailabilityTestCase(TransactionTestCase):
+    def setUp(self):
+        self.event = Event.objects.create(name='festival', datetime=datetime.datetime.now())
+        self.ticket = AvailableTicket.objects.create(event=self.event, amount_of_tickets=10, price=5.0, type='r')
+
+    @override_settings(LIVE_AVAILABILITY_COALESCE=0.05)
+    def test_stream(self):
+        app = live.application(None)
+        scope = {'type': 'http', 'path': f'/api/event/{self.event.id}/available_tickets/stream'}
+
+        async def stream():
+            disconnect = asyncio.Event()
+            outputs = [asyncio.Queue(), asyncio.Queue()]
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            streams = [asyncio.ensure_future(app(scope, receive, output.put)) for output in outputs]
+            for output in outputs:
+                self.assertEqual((await output.get())['status'], 200)
+                self.assertIn(b'"amount_of_tickets": 10', (await output.get())['body'])
+            # two reservations in one window make one update
+            await sync_to_async(inventory.reserve_tickets)(self.ticket, 1)
+            await sync_to_async(inventory.reserve_tickets)(self.ticket, 2)
+            updates = [(await asyncio.wait_for(output.get(), 1))['body'].decode() for output in outputs]
+            disconnect.set()
+            await asyncio.gather(*streams)
+            return updates
+
+        with mock.patch.object(live.broadcaster, '_read', wraps=live.broadcaster._read) as read:
+            updates = asyncio.run(stream())
+        self.assertEqual(updates[0], updates[1])
+        self.assertTrue(updates[0].startswith('event: update\n'))
+        self.assertEqual(json.loads(updates[0].split('data: ')[1]), [
+            {'id': self.ticket.id, 'type': 'r', 'amount_of_tickets': 7, 'delta': -3}
+        ])
+        # the initial stock and the update are read once for both subscribers
+        self.assertEqual(read.call_count, 2)
+        self.assertFalse(live.broadcaster._subscribers)
+
+    @override_settings(LIVE_AVAILABILITY_COALESCE=0.05)
+    def test_change_during_initial_read(self):
+        app = live.application(None)
+        scope = {'type': 'http', 'path': f'/api/event/{self.event.id}/available_tickets/stream'}
+        read = live.broadcaster._read
+
+        def read_then_reserve(event_ids):
+            amounts = read(event_ids)
+            if read_then_reserve.first:
+                # committed after the snapshot was read, before the stream got it
+                read_then_reserve.first = False
+                inventory.reserve_tickets(self.ticket, 1)
+            return amounts
+        read_then_reserve.first = True
+
+        async def stream():
+            disconnect = asyncio.Event()
+            output = asyncio.Queue()
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            task = asyncio.ensure_future(app(scope, receive, output.put))
+            self.assertEqual((await output.get())['status'], 200)
+            self.assertIn(b'"amount_of_tickets": 10', (await output.get())['body'])
+            update = (await asyncio.wait_for(output.get(), 1))['body'].decode()
+            disconnect.set()
+            await task
+            return update
+
+        with mock.patch.object(live.broadcaster, '_read', side_effect=read_then_reserve):
+            update = asyncio.run(stream())
+        self.assertEqual(json.loads(update.split('data: ')[1]), [
+            {'id': self.ticket.id, 'type': 'r', 'amount_of_tickets': 9, 'delta': -1}
+        ])
+        self.assertFalse(live.broadcaster._subscribers)
+
+    def test_unknown_event(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(live.application(None)({'type': 'http', 'path': '/api/event/1000/available_tickets/stream'},
+                                           None, send))
+        self.assertEqual(sent[0]['status'], 404)
+
+
+class AsyncPaymentGatewayTestCase(SimpleTestCase):
+    def test_charge(self):
+        gateway = payments_adapter.FakePaymentGateway(latency=0)
+        result = asyncio.run(gateway.charge(Decimal('5.00'), 'token'))
+        self.assertEqual(result, payments_adapter.PaymentResult(Decimal('5.00'), 'EUR'))
+        with self.assertRaises(payments_adapter.CurrencyError):
+            asyncio.run(gateway.charge(Decimal('5.00'), 'token', 'PLN'))
+
+    def test_timeout(self):
+        gateway = payments_adapter.FakePaymentGateway(latency=1, timeout=0.01)
+        with self.assertRaises(payments_adapter.PaymentTimeoutError):
+            asyncio.run(gateway.charge(Decimal('5.00'), 'token'))
+
+    def test_blocking_client_runs_outside_of_the_loop(self):
+        gateway = payments_adapter.AsyncPaymentGateway(timeout=0.05)
+        started = time.perf_counter()
+        with mock.patch.object(gateway._client, 'charge', side_effect=lambda *args, **kwargs: time.sleep(0.5)):
+            with self.assertRaises(payments_adapter.PaymentTimeoutError):
+                asyncio.run(gateway.charge(Decimal('5.00'), 'token'))
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+    def test_concurrency_limit(self):
+        gateway = payments_adapter.FakePaymentGateway(latency=0.05, max_concurrency=2)
+
+        async def charge_many():
+            started = time.perf_counter()
+            await asyncio.gather(*(gateway.charge(Decimal('5.00'), 'token') for _ in range(4)))
+            return time.perf_counter() - started
+
+        # 4 calls with 2 at a time need two rounds of latency, and the gateway keeps working in a new loop
+        self.assertGreaterEqual(asyncio.run(charge_many()), 0.1)
+        self.assertGreaterEqual(asyncio.run(charge_many()), 0.1)
+
+
+class AdmissionQueueTestCase(SimpleTestCase):
+    def test_burst_and_rate(self):
+        queue = admission.AdmissionQueue(rate=10, burst=3, max_wait=1)
+        self.assertEqual([queue.admit(1, now=0)[0] for _ in range(3)], [True, True, True])
+        admitted, token, wait = queue.admit(1, now=0)
+        self.assertEqual((admitted, round(wait, 3)), (False, 0.1))
+        # other events have their own queues
+        self.assertTrue(queue.admit(2, now=0)[0])
+        self.assertFalse(queue.admit(1, token, now=0.05)[0])
+        self.assertTrue(queue.admit(1, token, now=0.11)[0])
+        # a token is admitted only once
+        self.assertFalse(queue.admit(1, token, now=0.11)[0])
+
+    def test_max_wait(self):
+        queue = admission.AdmissionQueue(rate=10, burst=1, max_wait=0.25)
+        results = [queue.admit(1, now=0) for _ in range(5)]
+        self.assertEqual([admitted for admitted, _, _ in results], [True, False, False, False, False])
+        self.assertEqual([token is not None for _, token, _ in results[1:]], [True, True, False, False])
+        self.assertEqual(queue.position(results[2][2]), 2)
+
+
+class BenchmarkReportTestCase(SimpleTestCase):
+    def test_summary(self):
+        result = benchmarks.summary('endpoint', [i / 1000 for i in range(1, 101)], [2, 4], elapsed=2)
+        self.assertEqual((result['p50_ms'], result['p95_ms'], result['p99_ms']), (51, 96, 100))
+        self.assertEqual((result['rps'], result['queries_per_request']), (50, 3))
+
+    def test_compare(self):
+        baseline = {'endpoints': {'GET events/': {'p95_ms': 10, 'queries_per_request': 2}}}
+        results = {'endpoints': [
+            {'name': 'GET events/', 'p95_ms': 11.5, 'queries_per_request': 3},
+            {'name': 'GET reservations/', 'p95_ms': 100, 'queries_per_request': 100},
+        ]}
+        self.assertEqual(benchmarks.compare(results, baseline, tolerance=0.2),
+                         ['endpoints / GET events/: queries_per_request 3.000 > 2.000'])
+
+
+class BenchmarkTestCase(TransactionTestCase):
+    def test_endpoints_cover_every_route(self):
+        options = {'events': 2, 'reservations': 20, 'purchases': 20, 'requests': 4, 'concurrency': 2}
+        with benchmarks.benchmark_environment():
+            results = benchmarks.endpoints(options)
+        self.assertEqual([result['name'] for result in results if result['errors']], [])
+        routes = {re.sub(r'<str:(\w+)>', r'<\1>', re.sub(r'<int:\w+>', '<id>', str(pattern.pattern)))
+                  for pattern in urlpatterns}
+        self.assertEqual({result['name'].split(' ')[1].split('?')[0] for result in results}, routes)
+
+
+class ReplicaRouterTestCase(SimpleTestCase):
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_routing(self):
+        router = routers.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Event))
+        token = routers._replica_reads.set(True)
+        try:
+            self.assertEqual(router.db_for_read(Event), 'replica')
+            self.assertEqual(router.db_for_write(Event), 'default')
+        finally:
+            routers._replica_reads.reset(token)
+        self.assertFalse(router.allow_migrate('replica', 'tickets_component'))
+        self.assertTrue(router.allow_migrate('default', 'tickets_component'))
+
+    def test_without_replicas(self):
+        token = routers._replica_reads.set(True)
+        try:
+            self.assertIsNone(routers.ReplicaRouter().db_for_read(Event))
+        finally:
+            routers._replica_reads.reset(token)
@@ -0,0 +1,152 @@
+import csv
+import datetime
+import json
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .models import Event, AvailableTicket, PurchasedTicket
+from .serializers import TicketTierImportSerializer
+from .signals import stock_changed
+from . import caching
+
+FORMATS = ('csv', 'jsonl')
+IMPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 2000
+TIER_FIELDS = ('event', 'datetime', 'type', 'price', 'amount_of_tickets')
+EXPORTS = {
+    'stock': (AvailableTicket, (
+        'event_id', 'event__name', 'event__datetime', 'id', 'type', 'price', 'amount_of_tickets'
+    )),
+    'purchases': (PurchasedTicket, (
+        'id', 'owner_id', 'ticket_id', 'ticket__event_id', 'ticket__type', 'amount_of_tickets'
+    )),
+}
+
+
+class InvalidRowError(Exception):
+    def __init__(self, line, errors):
+        super().__init__(f'line {line}: {errors}')
+
+
+def format_of(path):
+    return 'jsonl' if str(path).endswith(('.jsonl', '.json')) else 'csv'
+
+
+def read_rows(lines, format_):
+    # yields (line number, row) without loading the whole file
+    if format_ == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(lines, 1):
+            if line.strip():
+                yield line_number, json.loads(line)
+
+
+def validate(rows):
+    for line_number, row in rows:
+        tier = TicketTierImportSerializer(data=row)
+        if not tier.is_valid():
+            raise InvalidRowError(line_number, dict(tier.errors))
+        yield tier.validated_data
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _events(keys):
+    # one lookup for the whole batch; events are told apart by their name and datetime
+    names = {name for name, _ in keys}
+    datetimes = {dt for _, dt in keys}
+    events = {}
+    for pk, name, dt in Event.objects.filter(name__in=names, datetime__in=datetimes).order_by('-id').values_list(
+            'id', 'name', 'datetime'):
+        if (name, dt) in keys:
+            events[(name, dt)] = pk
+    return events
+
+
+def _import_batch(tiers, replace_stock):
+    keys = {(tier['event'], tier['datetime']) for tier in tiers}
+    events = _events(keys)
+    missing = keys - events.keys()
+    if missing:
+        Event.objects.bulk_create([Event(name=name, datetime=dt) for name, dt in missing])
+        events = _events(keys)
+
+    existing = {
+        (ticket.event_id, ticket.type): ticket
+        for ticket in AvailableTicket.objects.filter(event_id__in=set(events.values()))
+    }
+    created, updated = {}, {}
+    for tier in tiers:
+        event_id = events[(tier['event'], tier['datetime'])]
+        ticket = existing.get((event_id, tier['type']))
+        if ticket is None:
+            # the last row of a tier wins, like it does for the existing ones
+            created[(event_id, tier['type'])] = AvailableTicket(
+                event_id=event_id, type=tier['type'], price=tier['price'], amount_of_tickets=tier['amount_of_tickets']
+            )
+        else:
+            ticket.price = tier['price']
+            if replace_stock:
+                # tickets held or sold since the stock was set come back, so it's only done on request
+                ticket.amount_of_tickets = tier['amount_of_tickets']
+            updated[ticket.pk] = ticket
+    AvailableTicket.objects.bulk_create(created.values())
+    fields = ['price', 'amount_of_tickets'] if replace_stock else ['price']
+    AvailableTicket.objects.bulk_update(updated.values(), fields)
+    return len(missing), len(created), len(updated), set(events.values())
+
+
+def import_tiers(rows, batch_size=IMPORT_BATCH_SIZE, dry_run=False, replace_stock=False):
+    # imports validated batches in their own transactions, so a bad row keeps the batches before it; the stock
+    # of existing tiers is kept unless `replace_stock`. Returns the numbers of created events, created tiers and
+    # updated tiers
+    totals = [0, 0, 0]
+    for batch in _batches(validate(rows), batch_size):
+        if dry_run:
+            continue
+        with transaction.atomic():
+            *counts, event_ids = _import_batch(batch, replace_stock)
+            # bulk_create and bulk_update don't send the signals invalidating the caches and notifying the streams
+            stock_changed.send(sender=AvailableTicket, event_ids=event_ids)
+        caching.invalidate(caching.CATALOGUE)
+        caching.invalidate(caching.TICKET_TERMS)
+        totals = [total + count for total, count in zip(totals, counts)]
+    return tuple(totals)
+
+
+def _plain(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def export_rows(kind):
+    model, fields = EXPORTS[kind]
+    for values in model.objects.order_by('pk').values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield dict(zip(fields, map(_plain, values)))
+
+
+def write_rows(rows, fields, format_, out):
+    if format_ == 'csv':
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            out.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
@@ -8,21 +8,38 @@ from .views import (
     user_reservations_view,
     event_available_tickets_view,
     reserve_ticket_view,
+    reserve_basket_view,
+    extend_reservation_view,
+    admission_view,
     payment_view,
+    async_payment_view,
+    checkout_view,
     tickets_statistics_view,
+    reserved_tickets_statistics_view,
+    reserved_tickets_series_view,
+    metrics_view,
 )
-from .models import PurchasedTicket, AvailableTicket
+from .models import PurchasedTicketStatistic, AvailableTicket
 
 urlpatterns = [
     path('event/<int:event_id>/', event_detail_view),
     path('events/', event_list_view),
     path('event/<int:event_id>/available_tickets', event_available_tickets_view),
     path('event/<int:event_id>/reserve_ticket', reserve_ticket_view),
+    path('event/<int:event_id>/reserve_tickets', reserve_basket_view),
+    path('event/<int:event_id>/admission/<str:token>', admission_view),
     path('reservations/', user_reservations_view),
+    path('reservations/<int:reservation_id>/extend', extend_reservation_view),
     path('reservations/payment', payment_view),
-    path('statistics/reserved_tickets/', partial(tickets_statistics_view, cls=AvailableTicket)),
-    path('statistics/reserved_tickets/<str:type_>/', partial(tickets_statistics_view, cls=AvailableTicket)),
-    path('statistics/purchased_tickets/', partial(tickets_statistics_view, cls=PurchasedTicket)),
-    path('statistics/purchased_tickets/<str:type_>/', partial(tickets_statistics_view, cls=PurchasedTicket)),
+    path('reservations/payment/async', async_payment_view),
+    path('reservations/payment/<int:checkout_id>', checkout_view),
+    path('statistics/available_tickets/', partial(tickets_statistics_view, cls=AvailableTicket)),
+    path('statistics/available_tickets/<str:type_>/', partial(tickets_statistics_view, cls=AvailableTicket)),
+    path('statistics/reserved_tickets/', reserved_tickets_statistics_view),
+    path('statistics/reserved_tickets/series/', reserved_tickets_series_view),
+    path('statistics/reserved_tickets/<str:type_>/', reserved_tickets_statistics_view),
+    path('statistics/purchased_tickets/', partial(tickets_statistics_view, cls=PurchasedTicketStatistic)),
+    path('statistics/purchased_tickets/<str:type_>/', partial(tickets_statistics_view, cls=PurchasedTicketStatistic)),
+    path('metrics/', metrics_view),
 ]
 
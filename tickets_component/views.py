@@ -1,127 +1,463 @@
+import asyncio
+import contextlib
 import datetime
+import hashlib
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from kombu.exceptions import OperationalError
 
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from django.db import connection
+from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.core.cache import cache
 from django.db.models import F, Sum
+from django.db.models.functions import Trunc, Greatest
 
 from .models import (
     Event,
     AvailableTicket,
     TicketReservation,
     PurchasedTicket,
+    Checkout,
     TICKET_TYPES,
 )
 from .serializers import (
     EventSerializer,
+    EventListQuerySerializer,
     AvailableTicketSerializer,
     TicketReservationSerializer,
+    RESERVATION_ROW_FIELDS,
+    represent_reservations,
+    BasketReservationSerializer,
     PaymentSerializer,
-    PurchasedTicketSerializer,
+    CheckoutSerializer,
+    CheckoutQuerySerializer,
+    StatisticsQuerySerializer,
+    ReservedTicketsSeriesQuerySerializer,
 )
 from .payments_adapter import payments as payments_adapter
+from .tasks import capture_payment
+from .idempotency import idempotent
+from .admission import admission_control
+from .routers import replica_reads, pins_primary
+from .signals import reservations_changed
+from . import inventory, caching, pagination, checkout, admission, metrics, routers, expiry
+
+CHECKOUT_POLL_INTERVAL = 0.2
+# ticket ids looked up in one query by the reserved tickets statistics
+STATISTICS_BATCH_SIZE = 500
 
 
 @api_view(['GET'])
+@replica_reads
 def event_detail_view(request, event_id):
-    ev = Event.objects.filter(id=event_id)
-    if not ev.exists():
-        return Response({}, status=404)
-    obj = ev.first()
-    serializer = EventSerializer(obj)
-    return Response(serializer.data)
+    def build():
+        obj = Event.objects.filter(id=event_id).first()
+        if obj is None:
+            return {}, 404
+        return EventSerializer(obj).data, 200
+
+    data, status = caching.cached(caching.event_scope(event_id), 'detail', build)
+    return Response(data, status=status)
 
 
 @api_view(['GET'])
+@replica_reads
 def event_list_view(request):
-    events = Event.objects.all()
-    serializer = EventSerializer(events, many=True)
-    return Response(serializer.data)
+    query = EventListQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    params = query.validated_data
+
+    events = Event.objects.order_by('datetime', 'id')
+    if 'since' in params:
+        events = events.filter(datetime__gte=params['since'])
+    if 'until' in params:
+        events = events.filter(datetime__lt=params['until'])
+    if 'cursor' in params:
+        events = pagination.after_cursor(events, params['cursor'])
+    if params['stream']:
+        return StreamingHttpResponse(pagination.stream_json(events, EventSerializer), content_type='application/json')
+
+    def build():
+        page = list(events[:params['limit'] + 1])
+        next_cursor = pagination.encode_cursor(page[params['limit'] - 1]) if len(page) > params['limit'] else None
+        return EventSerializer(page[:params['limit']], many=True).data, next_cursor
+
+    query_key = hashlib.md5(request.query_params.urlencode().encode()).hexdigest()
+    data, next_cursor = caching.cached(caching.CATALOGUE, f'list:{query_key}', build)
+    headers = {}
+    if next_cursor is not None:
+        next_params = request.query_params.copy()
+        next_params['cursor'] = next_cursor
+        headers['Link'] = f'<{request.build_absolute_uri("?" + next_params.urlencode())}>; rel="next"'
+    return Response(data, headers=headers)
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@replica_reads
 def user_reservations_view(request):
-    trs = TicketReservation.objects.filter(owner=request.user)
-    if not trs.exists():
-        return Response({}, status=404)
-    serializer = TicketReservationSerializer(trs, many=True)
-    return Response(serializer.data)
+    # clients poll it, so an unchanged list costs no query: its ETag is kept under the version of the user's
+    # reservations (bumped by every write) until the first of them expires
+    now = datetime.datetime.now()
+    scope = caching.owner_scope(request.user.id)
+    etag_key = f'tickets:{scope}:{caching.get_version(scope)}:etag'
+    current = cache.get(etag_key)
+    if current is not None and (current[1] is None or now <= current[1]):
+        if request.headers.get('If-None-Match') == current[0]:
+            return Response(status=304, headers={'ETag': current[0]})
+
+    rows = list(TicketReservation.objects.filter(owner=request.user, expiration_datetime__gte=now).order_by(
+        'expiration_datetime', 'id'
+    ).values(*RESERVATION_ROW_FIELDS))
+    fingerprint = ','.join(f'{row["id"]}:{row["expiration_datetime"]}' for row in rows)
+    etag = f'"{hashlib.md5(fingerprint.encode()).hexdigest()}"'
+    cache.set(etag_key, (etag, rows[0]['expiration_datetime'] if rows else None),
+              timeout=settings.TICKETS_CACHE_TIMEOUT)
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={'ETag': etag})
+    if not rows:
+        return Response({}, status=404, headers={'ETag': etag})
+    return Response(represent_reservations(rows), headers={'ETag': etag})
 
 
 @api_view(['GET'])
+@replica_reads
 def event_available_tickets_view(request, event_id):
-    tickets = AvailableTicket.objects.filter(event=event_id)
-    if not tickets.exists():
-        return Response({}, status=404)
-    serializer = AvailableTicketSerializer(tickets, many=True)
-    return Response(serializer.data)
+    def build():
+        with routers.primary_reads():
+            reclaimed = inventory.reclaim_expired_reservations(datetime.datetime.now(), ticket__event=event_id)
+        # the replicas don't have the stock given back by the reclaim yet
+        with routers.primary_reads() if reclaimed else contextlib.nullcontext():
+            tickets = inventory.current_amounts(
+                AvailableTicketSerializer(AvailableTicket.objects.filter(event=event_id), many=True).data
+            )
+        if not tickets:
+            return {}, 404
+        return tickets, 200
+
+    data, status = caching.cached(caching.event_scope(event_id), 'available_tickets', build)
+    return Response(data, status=status)
 
 
+@admission_control
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
+@pins_primary
 def reserve_ticket_view(request, event_id):
     reservation = TicketReservationSerializer(data=request.data)
     if reservation.is_valid(raise_exception=True):
-        t = AvailableTicket.objects.get(pk=reservation.validated_data['ticket'].id)
-        if t.amount_of_tickets >= reservation.validated_data['amount_of_tickets']:
-            t.amount_of_tickets = F('amount_of_tickets') - reservation.validated_data['amount_of_tickets']
-            t.save()
-            reservation.save(owner=request.user)
+        if reservation.validated_data['ticket'].event_id != event_id:
+            return Response({'message': 'Ticket does not exist for this event.'}, status=400)
+        with inventory.reserving():
+            reserved = inventory.reserve_tickets(
+                reservation.validated_data['ticket'],
+                reservation.validated_data['amount_of_tickets']
+            )
+            if reserved:
+                reservation.save(owner=request.user)
+        if reserved:
             return Response(reservation.data, status=201)
         else:
             return Response({'message': "Insufficient number of tickets available."}, status=400)
     return Response({}, status=400)
 
 
+@admission_control
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
+@pins_primary
+def reserve_basket_view(request, event_id):
+    basket = BasketReservationSerializer(data=request.data)
+    basket.is_valid(raise_exception=True)
+    items = basket.validated_data['tickets']
+    tickets = {item['ticket']: inventory.ticket_terms(item['ticket']) for item in items}
+    if any(t is None or t.event_id != event_id for t in tickets.values()):
+        return Response({'message': 'Ticket does not exist for this event.'}, status=400)
+
+    # the basket is held as long as its shortest held tickets
+    expiration_datetime = datetime.datetime.now() + min(t.hold_duration for t in tickets.values())
+    reservations = [
+        TicketReservation(owner=request.user, ticket=tickets[item['ticket']],
+                          amount_of_tickets=item['amount_of_tickets'],
+                          amount_to_pay=tickets[item['ticket']].price * item['amount_of_tickets'],
+                          expiration_datetime=expiration_datetime)
+        for item in items
+    ]
+    with inventory.reserving():
+        if not inventory.reserve_many({r.ticket: r.amount_of_tickets for r in reservations}):
+            return Response({'message': "Insufficient number of tickets available."}, status=400)
+        expiry.register([expiration_datetime])
+        reservations = TicketReservation.objects.bulk_create(reservations)
+        reservations_changed.send(sender=TicketReservation, owner_ids=[request.user.id])
+        if not connection.features.can_return_rows_from_bulk_insert:
+            # the database doesn't give back ids of the inserted rows, so they're read once again
+            reservations = list(TicketReservation.objects.select_related('ticket').filter(
+                owner=request.user, expiration_datetime=expiration_datetime, ticket__in=list(tickets)
+            ))
+    return Response({
+        'reservations': TicketReservationSerializer(reservations, many=True).data,
+        'amount_to_pay': sum(r.amount_to_pay for r in reservations),
+        'expiration_datetime': expiration_datetime,
+    }, status=201)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@pins_primary
+def extend_reservation_view(request, reservation_id):
+    # "I'm still paying": one more hold of the ticket from now on, up to RESERVATION_MAX_EXTENSIONS times
+    now = datetime.datetime.now()
+    hold_minutes = AvailableTicket.objects.filter(ticketreservation=reservation_id).values_list(
+        'hold_minutes', flat=True
+    ).first()
+    hold = settings.RESERVATION_HOLD_DURATION if hold_minutes is None else datetime.timedelta(minutes=hold_minutes)
+    expiration_datetime = now + hold
+    expiry.register([expiration_datetime])
+    extended = TicketReservation.objects.filter(
+        pk=reservation_id, owner=request.user, expiration_datetime__gte=now,
+        extensions__lt=settings.RESERVATION_MAX_EXTENSIONS
+    ).update(expiration_datetime=Greatest(F('expiration_datetime'), expiration_datetime),
+             extensions=F('extensions') + 1)
+    if not extended:
+        return Response({'message': 'Reservation cannot be extended.'}, status=400)
+    reservations_changed.send(sender=TicketReservation, owner_ids=[request.user.id])
+    return Response(TicketReservation.objects.filter(pk=reservation_id).values('expiration_datetime', 'extensions')[0])
+
+
+@api_view(['GET'])
+def admission_view(request, event_id, token):
+    wait = admission.queue.wait(event_id, token)
+    if wait is None:
+        return Response({}, status=404)
+    return Response({'position': admission.queue.position(wait), 'retry_after': wait})
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@idempotent
+@pins_primary
 def payment_view(request):
     payment = PaymentSerializer(data=request.data)
     if payment.is_valid(raise_exception=True):
         reservations_indicies = payment.validated_data['reservations']
         amount_to_pay = payment.validated_data['amount']
         currency = payment.validated_data['currency']
+        token = payment.validated_data['token']
 
-        reservations = TicketReservation.objects.filter(
-            pk__in=reservations_indicies).filter(
-            expiration_datetime__gte=datetime.datetime.now()
-        )
+        try:
+            ch = checkout.authorize(request.user, reservations_indicies, amount_to_pay, currency, token)
+        except checkout.CheckoutError as ex:
+            return Response({'message': str(ex)}, status=400)
+        # the gateway is charged in the background; the client polls the checkout for the result
+        try:
+            capture_payment.delay(ch.id)
+        except OperationalError:
+            # the broker is down, so the reservations are given back to be paid once again
+            checkout.fail(ch.id, 'Payment could not be queued.')
+            return Response({'message': 'Payment could not be queued, try again later.'}, status=503)
+        ch.refresh_from_db()
+        return Response(CheckoutSerializer(ch).data, status=202,
+                        headers={'Location': request.build_absolute_uri(f'/api/reservations/payment/{ch.id}')})
+    return Response({}, status=400)
+
+
+def _authenticated_user(request):
+    return request.user if request.user.is_authenticated else None
+
+
+def _checkout_data(user, checkout_id):
+    ch = Checkout.objects.filter(pk=checkout_id, owner=user).first()
+    return None if ch is None else CheckoutSerializer(ch).data
+
+
+async def checkout_view(request, checkout_id):
+    # plain Django async view, so a long-poll waits on the event loop instead of holding a worker thread
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    user = await sync_to_async(_authenticated_user, thread_sensitive=True)(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=403)
+    query = CheckoutQuerySerializer(data=request.GET)
+    if not query.is_valid():
+        return JsonResponse(query.errors, status=400)
+    deadline = time.monotonic() + query.validated_data['wait']
+    while True:
+        data = await sync_to_async(_checkout_data, thread_sensitive=True)(user, checkout_id)
+        if data is None:
+            return JsonResponse({}, status=404)
+        # long-poll: with `wait` the response is held until the capture ends or the time runs out
+        if data['status'] not in checkout.OPEN_STATUSES or time.monotonic() >= deadline:
+            return JsonResponse(data)
+        await asyncio.sleep(CHECKOUT_POLL_INTERVAL)
 
-        if set(reservations_indicies) != {r.id for r in reservations}:
-            return Response({'message': 'Reservation does not exist or expired.'}, status=400)
-        if amount_to_pay != reservations.aggregate(Sum('amount_to_pay'))['amount_to_pay__sum']:
-            return Response({'message': 'Wrong amount of money for this payment request.'}, status=400)
 
-        payment_gateway = payments_adapter.PaymentGateway()
+def _capture(checkout_id):
+    try:
+        checkout.capture(checkout_id)
+    except payments_adapter.PaymentError:
+        # the checkout stays open for the next attempt
+        pass
+
+
+async def async_payment_view(request):
+    # plain Django async view (DRF views are sync only), so a slow gateway doesn't hold a worker thread under ASGI
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    user = await sync_to_async(_authenticated_user, thread_sensitive=True)(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=403)
+    try:
+        payment = PaymentSerializer(data=json.loads(request.body))
+    except ValueError:
+        return JsonResponse({'detail': 'JSON parse error.'}, status=400)
+    if not payment.is_valid():
+        return JsonResponse(payment.errors, status=400)
+    reservations_indicies = payment.validated_data['reservations']
+    amount_to_pay = payment.validated_data['amount']
+    currency = payment.validated_data['currency']
+
+    token = payment.validated_data['token']
+
+    try:
+        # the checkout claims the reservations, so neither another payment nor the sync endpoint can charge them
+        ch = await sync_to_async(checkout.hold_reservations, thread_sensitive=True)(
+            user, reservations_indicies, amount_to_pay, currency, token
+        )
+    except checkout.CheckoutError as ex:
+        return JsonResponse({'message': str(ex)}, status=400)
+    try:
+        with metrics.timer('gateway'):
+            payment_result = await checkout.async_payment_gateway().charge(
+                amount_to_pay, token, currency, reference=f'checkout-{ch.id}'
+            )
+    except payments_adapter.PaymentTimeoutError:
+        # the reservations aren't given back, the client polls the checkout for the result of the capture
+        await sync_to_async(checkout.reconcile, thread_sensitive=True)(ch.id)
         try:
-            payment_result = payment_gateway.charge(amount_to_pay, currency)
-        except (payments_adapter.CardError, payments_adapter.CurrencyError, payments_adapter.PaymentError) as ex:
-            return Response({'message': ex}, status=400)
-        else:
-            if payment_result.amount == amount_to_pay and payment_result.currency == currency:
-                reservation_dicts = TicketReservationSerializer(reservations, many=True).data
-                for dct in reservation_dicts:
-                    dct.update({'owner': request.user.id})
-                purchased_tickets = PurchasedTicketSerializer(data=reservation_dicts, many=True)
-                if purchased_tickets.is_valid(raise_exception=True):
-                    purchased_tickets.save()
-                    reservations.delete()
-                    return Response({'message': 'Payment succeeded.'}, status=200)
-    return Response({}, status=400)
+            await sync_to_async(capture_payment.delay)(ch.id)
+        except OperationalError:
+            # the broker is down as well, so the capture runs right here
+            await sync_to_async(_capture)(ch.id)
+        data = await sync_to_async(_checkout_data, thread_sensitive=True)(user, ch.id)
+        response = JsonResponse(data, status=202)
+        response['Location'] = request.build_absolute_uri(f'/api/reservations/payment/{ch.id}')
+        return response
+    except (payments_adapter.CardError, payments_adapter.CurrencyError, payments_adapter.PaymentError) as ex:
+        await sync_to_async(checkout.fail, thread_sensitive=True)(ch.id, str(ex))
+        return JsonResponse({'message': str(ex)}, status=400)
+    if payment_result.amount != amount_to_pay or payment_result.currency != currency:
+        await sync_to_async(checkout.fail, thread_sensitive=True)(
+            ch.id, 'Payment result does not match the payment request.'
+        )
+        return JsonResponse({}, status=400)
+    try:
+        await sync_to_async(checkout.finish_checkout, thread_sensitive=True)(ch.id)
+    except checkout.CheckoutError as ex:
+        return JsonResponse({'message': str(ex)}, status=400)
+    routers.pin_to_primary(user.id)
+    return JsonResponse({'message': 'Payment succeeded.'}, status=200)
 
 
-@api_view(['GET'])
-def tickets_statistics_view(request, type_=None, cls=None):
+def _filter_tickets(request, tickets, type_):
+    query = StatisticsQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    if 'event' in query.validated_data:
+        tickets = tickets.filter(event_id=query.validated_data['event'])
+
     ticket_types_dict = dict(TICKET_TYPES)
     if type_ in ticket_types_dict.keys():
-        tickets = cls.objects.filter(type=type_)
+        tickets = tickets.filter(type=type_)
     elif type_ in ticket_types_dict.values():
         type_ = {v: k for k, v in ticket_types_dict.items()}[type_]
-        tickets = cls.objects.filter(type=type_)
-    else:
-        tickets = cls.objects.all()
+        tickets = tickets.filter(type=type_)
+    return tickets, 'event' in query.validated_data
+
+
+def _statistics_response(request, tickets, type_):
+    tickets, _ = _filter_tickets(request, tickets, type_)
+    ticket_types_dict = dict(TICKET_TYPES)
     tickets_data = tickets.values('event_id', 'type').annotate(quantity=Sum('amount_of_tickets'))
     for dct in tickets_data:
         dct['type'] = ticket_types_dict[dct['type']]
     return Response(tickets_data)
+
+
+def _reserved_tickets_statistics(request, type_):
+    tickets, by_event = _filter_tickets(request, AvailableTicket.objects.all(), type_)
+    reservations = TicketReservation.objects.filter(expiration_datetime__gte=datetime.datetime.now())
+    if by_event:
+        # the few tickets of the event lead, each with a range of the (ticket, expiration_datetime) index
+        reservations = reservations.filter(ticket__in=tickets)
+    # otherwise the active range of the (expiration_datetime, ticket, amount_of_tickets) index is summed per ticket
+    # without reading the reservations, and only the tickets found are looked up
+    quantities = dict(reservations.values_list('ticket_id').annotate(quantity=Sum('amount_of_tickets')))
+    ticket_ids = list(quantities)
+    totals = {}
+    for i in range(0, len(ticket_ids), STATISTICS_BATCH_SIZE):
+        batch = tickets.filter(pk__in=ticket_ids[i:i + STATISTICS_BATCH_SIZE])
+        for ticket_id, event_id, ticket_type in batch.values_list('id', 'event_id', 'type'):
+            totals[event_id, ticket_type] = totals.get((event_id, ticket_type), 0) + quantities[ticket_id]
+    ticket_types_dict = dict(TICKET_TYPES)
+    return [
+        {'event_id': event_id, 'type': ticket_types_dict[ticket_type], 'quantity': quantity}
+        for (event_id, ticket_type), quantity in sorted(totals.items())
+    ]
+
+
+def _active_reservations():
+    return TicketReservation.objects.filter(expiration_datetime__gte=datetime.datetime.now())
+
+
+@api_view(['GET'])
+@replica_reads
+def tickets_statistics_view(request, type_=None, cls=None):
+    return _statistics_response(request, cls.objects.all(), type_)
+
+
+@api_view(['GET'])
+@replica_reads
+def reserved_tickets_statistics_view(request, type_=None):
+    # dashboards poll it every few seconds, so it's served from a short-lived cache entry instead of
+    # slowing down the reservation path with invalidations
+    def build():
+        return _reserved_tickets_statistics(request, type_), 200
+
+    query_key = hashlib.md5(request.query_params.urlencode().encode()).hexdigest()
+    data, status = caching.cached(caching.STATISTICS, f'reserved:{type_}:{query_key}', build,
+                                  timeout=settings.TICKETS_STATISTICS_CACHE_TIMEOUT)
+    return Response(data, status=status)
+
+
+@api_view(['GET'])
+@replica_reads
+def reserved_tickets_series_view(request):
+    query = ReservedTicketsSeriesQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    params = query.validated_data
+
+    def build():
+        reservations = _active_reservations()
+        if 'event' in params:
+            reservations = reservations.filter(ticket__event_id=params['event'])
+        series = reservations.annotate(
+            expiration=Trunc('expiration_datetime', params['bucket'])
+        ).values('expiration').annotate(quantity=Sum('amount_of_tickets')).order_by('expiration')
+        return list(series)
+
+    query_key = hashlib.md5(request.query_params.urlencode().encode()).hexdigest()
+    return Response(caching.cached(caching.STATISTICS, f'reserved_series:{query_key}', build,
+                                   timeout=settings.TICKETS_STATISTICS_CACHE_TIMEOUT))
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics_view(request):
+    return Response(metrics.snapshot())
@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tickets_system.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once Django is set up; serves the live availability streams and hands everything else to Django
+from tickets_component import live  # noqa: E402
+
+application = live.application(django_application)
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        # a transaction which reads before it writes can't wait for the lock of the file once another one has
+        # written (SQLite fails it at once), so every transaction takes the write lock up front and waits for it
+        self.cursor().execute('BEGIN IMMEDIATE')
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import datetime
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tickets_component.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,13 +80,148 @@ WSGI_APPLICATION = 'tickets_system.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
+# SQLite by default, set DATABASE_ENGINE=postgresql (and the other DATABASE_* variables) to run several workers
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite3')
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DATABASE_NAME', 'tickets_system'),
+            'USER': os.environ.get('DATABASE_USER', ''),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', ''),
+            'PORT': os.environ.get('DATABASE_PORT', ''),
+            # persistent connections instead of a new one for every request
+            'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+            # a transaction-pooling pgbouncer in front of the database can't keep server-side cursors open
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DATABASE_PGBOUNCER') == '1',
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            # the stock SQLite backend tuned for concurrent writers, see tickets_system/backends/sqlite3
+            'ENGINE': 'tickets_system.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # seconds a writer waits for the lock of the file before failing with "database is locked"
+                'timeout': 20,
+            },
+            # an in-memory database shares one cache between threads and fails concurrent tests with table locks
+            'TEST': {
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
+        }
+    }
+    # another connection to the same file, standing in for a replica where the tests route reads to it
+    DATABASES['replica'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+
+# read-only endpoints are served by these aliases (see tickets_component/routers.py), the other ones and every
+# write go to 'default'
+REPLICA_DATABASES = []
+if DATABASE_ENGINE == 'postgresql' and os.environ.get('DATABASE_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.environ['DATABASE_REPLICA_HOST'],
+        'PORT': os.environ.get('DATABASE_REPLICA_PORT', DATABASES['default']['PORT']),
+        'TEST': {'MIRROR': 'default'},
+    }
+    REPLICA_DATABASES = ['replica']
+
+DATABASE_ROUTERS = ['tickets_component.routers.ReplicaRouter']
+
+# how long (in seconds) a user who has reserved or paid reads from the primary, longer than the replication lag;
+# cache entries rebuilt this long after an invalidation are read from the primary too
+READ_YOUR_WRITES_WINDOW = 5
+
+# pragmas of every SQLite connection: readers don't block the writer in WAL mode, and NORMAL only syncs the WAL
+# at checkpoints, which may lose the last transactions on a power loss but never corrupts the database
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
     }
 }
 
+# upper bound (in seconds) on how stale a cached catalogue or availability response may be
+TICKETS_CACHE_TIMEOUT = 5
+# how long (in seconds) the reserved tickets statistics may lag behind the reservations
+TICKETS_STATISTICS_CACHE_TIMEOUT = 2
+
+# events listing page sizes (the whole catalogue is available with `?stream=true`)
+EVENTS_PAGE_SIZE = 100
+EVENTS_MAX_PAGE_SIZE = 1000
+
+
+# live availability streams (served through asgi.py): stock changes of an event are pushed at most once per
+# this many seconds, and idle streams get a keepalive comment this often
+LIVE_AVAILABILITY_COALESCE = 0.5
+LIVE_AVAILABILITY_KEEPALIVE = 15
+
+
+# Reservations
+RESERVATION_HOLD_DURATION = datetime.timedelta(minutes=15)
+# how many times a reservation can be held once more while its owner is still paying
+RESERVATION_MAX_EXTENSIONS = 2
+# waiting room in front of the reservation endpoints: requests admitted per second and per event (in every
+# process), the burst admitted at once and the longest wait (in seconds) handed out before turning clients away
+ADMISSION_RATE = 100
+ADMISSION_BURST = 200
+ADMISSION_MAX_WAIT = 300
+# stock of these events is owned by an in-memory ledger (see tickets_component/ledger.py) answering reservations
+# without the hot AvailableTicket UPDATE; the ledger is per process, so only enable it with a single worker process
+INVENTORY_LEDGER_EVENTS = []
+INVENTORY_LEDGER_JOURNAL = BASE_DIR / 'inventory_ledger.journal'
+# fsync the journal before every reservation is acknowledged
+INVENTORY_LEDGER_FSYNC = True
+# seconds between the writes of the journalled changes to AvailableTicket
+INVENTORY_LEDGER_FLUSH_INTERVAL = 1
+
+
+# Payments
+PAYMENT_GATEWAY_TIMEOUT = 10
+PAYMENT_GATEWAY_MAX_CONCURRENCY = 50
+# set to a number of seconds to replace the gateway with a local fake answering after that latency
+PAYMENT_GATEWAY_FAKE_LATENCY = None
+# how long reservations are kept alive while their payment is being charged
+PAYMENT_HOLD_DURATION = datetime.timedelta(seconds=2 * PAYMENT_GATEWAY_TIMEOUT)
+# how long reservations are kept alive while their checkout waits for the capture in the background
+CHECKOUT_HOLD_DURATION = datetime.timedelta(minutes=10)
+CHECKOUT_CAPTURE_MAX_RETRIES = 3
+# longest long-poll (in seconds) for the checkout status
+CHECKOUT_MAX_WAIT = 30
+
+# responses stored for the `Idempotency-Key` header are replayed for this long
+IDEMPOTENCY_KEY_TTL = datetime.timedelta(hours=24)
+# a request which claimed its key and never finished (its worker was killed) gives it up after this long, so it
+# must outlast the slowest request
+IDEMPOTENCY_CLAIM_LEASE = datetime.timedelta(seconds=60)
+# number of stored responses kept in memory of every process in front of the database
+IDEMPOTENCY_LRU_SIZE = 10000
+
+# requests slower than this (in seconds) keep their SQL in the samples exposed by `api/metrics/`
+METRICS_SLOW_REQUEST_THRESHOLD = 0.5
+METRICS_SLOW_REQUEST_SAMPLES = 20
+
+
+# Celery
+# https://docs.celeryproject.org/en/stable/django/first-steps-with-django.html
+
+CELERY_BROKER_URL = 'amqp://localhost'
+CELERY_TASK_IGNORE_RESULT = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -123,11 +261,17 @@ USE_TZ = False
 
 STATIC_URL = '/static/'
 
-# every minute get rid of obsolete reservations
+# every minute get rid of obsolete reservations nobody has touched (the request path reclaims the others on demand),
+# every hour forget expired idempotency keys
 CRONJOBS = [
     (
         '*/1 * * * *',
         'tickets_component.tasks.remove_obsolete_reservations',
         '>> ' + str(BASE_DIR / 'removing_obsolete_reservations.log'),
     ),
+    (
+        '0 * * * *',
+        'tickets_component.tasks.remove_expired_idempotency_keys',
+        '>> ' + str(BASE_DIR / 'removing_expired_idempotency_keys.log'),
+    ),
 ]